@@ -0,0 +1,238 @@
+import logging
+import random
+from twisted.internet import reactor
+
+import Tracker
+import HttpTracker
+
+DEFAULT_INTERVAL = 1800 #seconds, if tracker doesn't say
+RETRY_DELAY = 60 #seconds, doubled on every failure of a tracker
+MAX_RETRY_DELAY = 3600
+ANNOUNCE_TIMEOUT = 20 #seconds before next tracker of tier is tried
+
+
+class TrackerEntry(object):
+    """A tracker url of a tier and how announcing to it went"""
+    def __init__(self, url, tracker):
+        self.url = url
+        self.tracker = tracker #None if scheme is not supported
+        self.status = 'idle' if tracker is not None else 'unsupported'
+        self.error = None
+        self.failures = 0
+        self.next_try = 0 #time before which tracker is not retried
+        self.last_announce = None
+        self.interval = None
+        self.min_interval = None
+        self.seeders = self.leechers = -1 #negative means unknown
+        self.peers = 0 #peers got in last reply
+
+    def usable(self, now):
+        return self.tracker is not None and self.next_try <= now
+
+    def succeeded(self, now, result):
+        self.status = 'working'
+        self.error = None
+        self.failures = 0
+        self.next_try = 0
+        self.last_announce = now
+        self.interval = result.interval
+        self.min_interval = result.min_interval
+        if result.seeders is not None: self.seeders = result.seeders
+        if result.leechers is not None: self.leechers = result.leechers
+        self.peers = len(result.peers)
+
+    def earliest(self):
+        """time before which min interval of tracker forbids announcing"""
+        if self.last_announce is None or not self.min_interval: return 0
+        return self.last_announce + self.min_interval
+
+    def failed(self, now, error):
+        self.status = 'error'
+        self.error = error
+        self.failures += 1
+        self.next_try = now + min(RETRY_DELAY*2**(self.failures-1), MAX_RETRY_DELAY)
+
+    def describe(self):
+        return {
+            'url': self.url,
+            'status': self.status,
+            'error': self.error,
+            'failures': self.failures,
+            'seeders': self.seeders,
+            'leechers': self.leechers,
+            'peers': self.peers,
+            'last_announce': self.last_announce,
+            'next_try': self.next_try or None,
+        }
+
+
+class Tier(object):
+    """Trackers of a tier are tried in order until one answers, which
+       is then moved to the front(BEP 12).
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.timer = None
+        self.deadline = None #fails announce to current when it fires
+        self.current = None #entry being announced to
+        self.started = False #a tracker of tier got 'started' event
+        self.event = None #event to send with next announce
+        self.sending = None #event of announce in flight
+
+    def clear_deadline(self):
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+
+    def cancel(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        self.clear_deadline()
+        if self.current is not None:
+            current, self.current = self.current, None
+            current.status = 'idle'
+            current.tracker.cancel()
+
+
+class Announcer(object):
+    """Announces torrent to all tiers of its trackers in parallel. Order
+       within a tier is shuffled once. A tracker which fails or doesn't
+       answer in ANNOUNCE_TIMEOUT is backed off RETRY_DELAY*2**n seconds
+       and next one of its tier is tried at once.
+    """
+    def __init__(self, torrent, tiers, udp_client=None, http_agent=None):
+        self._torrent = torrent
+        self._udp_client = udp_client
+        self._http_agent = http_agent
+        self.tiers = []
+        for urls in tiers:
+            urls = list(urls)
+            random.shuffle(urls)
+            self.tiers.append(Tier([TrackerEntry(url, self._make_tracker(url))
+                                    for url in urls]))
+        self.running = False
+
+    def _make_tracker(self, url):
+        try:
+            if url.startswith('udp://'):
+                return Tracker.UDPTracker(self._torrent, url, self._udp_client)
+            if url.startswith(('http://', 'https://')):
+                return HttpTracker.HttpTracker(self._torrent, url, self._http_agent)
+        except ValueError:
+            pass
+        logging.warning("Tracker %s not supported", url)
+        return None
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        for tier in self.tiers:
+            tier.started = False
+            tier.event = None
+            self._announce(tier)
+
+    def stop(self):
+        """cancels announces and tells trackers which know us that we stopped"""
+        if not self.running: return
+        self.running = False
+        for tier in self.tiers:
+            tier.cancel()
+            if tier.started:
+                self._send_event(tier, 'stopped')
+
+    def completed(self):
+        """'completed' goes with next announce of every tier, at once
+           unless an announce is in flight
+        """
+        for tier in self.tiers:
+            tier.event = 'completed'
+            if tier.started and tier.current is None:
+                tier.cancel()
+                self._announce(tier)
+
+    def reannounce(self):
+        """announces to every tier as soon as min interval of its last
+           tracker allows, backed off trackers included
+        """
+        now = reactor.seconds()
+        for tier in self.tiers:
+            for e in tier.entries: e.next_try = 0
+            if tier.current is None:
+                tier.cancel()
+                delay = tier.entries[0].earliest() - now
+                if delay > 0:
+                    tier.timer = reactor.callLater(delay, self._announce, tier)
+                else:
+                    self._announce(tier)
+
+    def _send_event(self, tier, event):
+        e = tier.entries[0]
+        if e.tracker is None: return
+        d = e.tracker.announce(event)
+        d.addErrback(lambda f: logging.info("%s %s failed: %s", e.url, event,
+                                            f.getErrorMessage()))
+
+    def _announce(self, tier, start=0):
+        """announces to first usable tracker of tier from start on"""
+        tier.timer = None
+        if not self.running: return
+        now = reactor.seconds()
+        for i in range(start, len(tier.entries)):
+            e = tier.entries[i]
+            if e.usable(now): break
+        else:
+            retry = [e.next_try for e in tier.entries if e.tracker is not None]
+            if retry:
+                tier.timer = reactor.callLater(max(min(retry) - now, 0), self._announce, tier)
+            return
+        tier.current = e
+        e.status = 'announcing'
+        tier.deadline = reactor.callLater(ANNOUNCE_TIMEOUT, self._timed_out, tier, e)
+        tier.sending = tier.event if tier.started else 'started'
+        d = e.tracker.announce(tier.sending)
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(tier, e), errbackArgs=(tier, e))
+
+    def _succeeded(self, result, tier, e):
+        if tier.current is not e: return
+        tier.current = None
+        tier.clear_deadline()
+        now = reactor.seconds()
+        e.succeeded(now, result)
+        tier.started = True
+        if tier.sending == tier.event: tier.event = None
+        tier.entries.remove(e)
+        tier.entries.insert(0, e)
+        if e.seeders >= 0 and e.leechers >= 0:
+            self._torrent.scraped(e.url, e.seeders, None, e.leechers)
+        if result.peers and self.running:
+            self._torrent.peer_list_update(result.peers)
+        interval = result.interval or DEFAULT_INTERVAL
+        if result.min_interval: interval = max(interval, result.min_interval)
+        if tier.event is not None: interval = 0 #completed while 'started' was in flight
+        tier.timer = reactor.callLater(interval, self._announce, tier)
+
+    def _failed(self, failure, tier, e):
+        if tier.current is not e: return
+        tier.current = None
+        tier.clear_deadline()
+        self._next_tracker(tier, e, failure.getErrorMessage())
+
+    def _timed_out(self, tier, e):
+        tier.deadline = None
+        if tier.current is not e: return
+        tier.current = None
+        e.tracker.cancel()
+        self._next_tracker(tier, e, "Timed out")
+
+    def _next_tracker(self, tier, e, error):
+        e.failed(reactor.seconds(), error)
+        logging.info("Announce to %s failed: %s", e.url, e.error)
+        self._announce(tier, tier.entries.index(e) + 1)
+
+    def urls(self):
+        return [e.url for tier in self.tiers for e in tier.entries]
+
+    def describe(self):
+        return [[e.describe() for e in tier.entries] for tier in self.tiers]
@@ -0,0 +1,104 @@
+import random
+from twisted.internet import reactor
+
+import PeerProtocol
+
+UPLOAD_SLOTS = 4 #including the optimistic slot
+CHOKE_INTERVAL = 10 #seconds
+OPTIMISTIC_ROUNDS = 3 #optimistic slot rotates every these many rechokes
+
+
+class Choker(object):
+    """Tit-for-tat choker of a torrent.
+
+       Every interval the interested peers which gave us most data in
+       the last round are unchoked, the rest is choked. While seeding,
+       peers we upload to fastest are preferred instead. One more slot
+       is given to a random choked peer and rotated every
+       OPTIMISTIC_ROUNDS so that new peers get a chance to reciprocate.
+
+       LAN peers found by LNDP are never choked.
+    """
+    def __init__(self, torrent, slots=UPLOAD_SLOTS, interval=CHOKE_INTERVAL,
+                 optimistic_rounds=OPTIMISTIC_ROUNDS):
+        self._torrent = torrent
+        self.slots = max(1, slots)
+        self.interval = interval
+        self.optimistic_rounds = optimistic_rounds
+        self.optimistic = None
+        self.rates = {} #peer -> (download rate, upload rate) of last round
+        self._last = {} #peer -> (payload_down, payload_up) at last rechoke
+        self._last_time = None
+        self._round = 0
+        self._timer = None
+
+    def start(self):
+        if self._timer is None:
+            self._timer = reactor.callLater(0, self._tick)
+
+    def stop(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _tick(self):
+        self._timer = reactor.callLater(self.interval, self._tick)
+        self.rechoke()
+
+    def _peers(self):
+        return [p for p in self._torrent.current_protocols
+                if p.state == PeerProtocol.BTProtocolStates.connected]
+
+    def _update_rates(self, peers, now):
+        elapsed = now - self._last_time if self._last_time is not None else 0
+        last, self._last = self._last, {}
+        self.rates = {}
+        for p in peers:
+            down, up = p.payload_down, p.payload_up
+            d0, u0 = last.get(p, (down, up))
+            if elapsed > 0:
+                self.rates[p] = ((down - d0)/elapsed, (up - u0)/elapsed)
+            else:
+                self.rates[p] = (0.0, 0.0)
+            self._last[p] = (down, up)
+        self._last_time = now
+
+    def rechoke(self, now=None):
+        peers = self._peers()
+        self._update_rates(peers, now if now is not None else reactor.seconds())
+        seeding = self._torrent.finished() #wanted files are complete
+        rate = 1 if seeding else 0
+        wan = [p for p in peers if not p._is_lndp]
+        interested = [p for p in wan if p.peer_interested]
+        interested.sort(key=lambda p: self.rates[p][rate], reverse=True)
+        unchoke = set(interested[:self.slots - 1])
+
+        if (self.optimistic not in wan or not self.optimistic.peer_interested
+                or self.optimistic in unchoke):
+            self.optimistic = None
+        if self._round % self.optimistic_rounds == 0 or self.optimistic is None:
+            candidates = [p for p in interested if p not in unchoke]
+            self.optimistic = random.choice(candidates) if candidates else None
+        self._round += 1
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for p in peers:
+            if p._is_lndp or p in unchoke:
+                if p.am_choking: p._send_unchoke()
+            elif not p.am_choking:
+                p._send_choke()
+
+    def peer_interested(self, peer):
+        """unchokes peer at once if a slot is free"""
+        if not peer.am_choking: return
+        unchoked = sum(1 for p in self._peers()
+                       if not p.am_choking and not p._is_lndp)
+        if peer._is_lndp or unchoked < self.slots:
+            peer._send_unchoke()
+
+    def peer_lost(self, peer):
+        self._last.pop(peer, None)
+        self.rates.pop(peer, None)
+        if peer is self.optimistic:
+            self.optimistic = None
@@ -0,0 +1,183 @@
+import logging
+from twisted.internet import reactor
+
+import PeerProtocol
+
+MAX_PEERS = 50 #per torrent
+MAX_SESSION_PEERS = 200
+MAX_HALF_OPEN = 8 #connects in progress, per session
+CONNECT_TIMEOUT = 10 #seconds
+CONNECT_INTERVAL = 2 #seconds between attempts to fill free slots
+BACKOFF = 30 #seconds after first failure, doubled with every next one
+MAX_BACKOFF = 3600
+MAX_FAILURES = 8 #peer is forgotten after these many failures in a row
+RECONNECT_DELAY = 60 #seconds before reconnecting a peer which closed fine
+
+
+class PeerInfo(object):
+    """what we know about a peer address from earlier connections"""
+    __slots__ = ('addr', 'failures', 'next_try', 'rate', 'connected_at', 'protocol')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.failures = 0
+        self.next_try = 0
+        self.rate = 0.0 #best payload bytes/s downloaded from it
+        self.connected_at = None
+        self.protocol = None
+
+    def score(self):
+        return self.rate/(1 + self.failures)
+
+
+class ConnectionBudget(object):
+    """Connection limits shared by all torrents of a session"""
+    def __init__(self, max_peers=MAX_SESSION_PEERS, max_half_open=MAX_HALF_OPEN):
+        self.max_peers = max_peers
+        self.max_half_open = max_half_open
+        self.managers = set()
+
+    def peers(self):
+        return sum(m.peer_count() for m in self.managers)
+
+    def half_open(self):
+        return sum(len(m.half_open) for m in self.managers)
+
+    def free_slots(self):
+        return min(self.max_peers - self.peers() - self.half_open(),
+                   self.max_half_open - self.half_open())
+
+
+_default_budget = None
+
+def default_budget():
+    """ConnectionBudget shared by all torrents of the process"""
+    global _default_budget
+    if _default_budget is None:
+        _default_budget = ConnectionBudget()
+    return _default_budget
+
+
+class ConnectionManager(object):
+    """Opens outgoing connections of a torrent.
+
+       Known peers are tried best score first, i.e. fastest peers of
+       earlier connections before unknown ones and those which failed.
+       Failed peers are retried with exponential backoff. Established
+       outgoing connections are in torrent.connections. Outcomes are
+       also recorded in store, a PeerStore.PeerStore, if given.
+    """
+    def __init__(self, torrent, max_peers=MAX_PEERS, budget=None, store=None):
+        self._torrent = torrent
+        self.max_peers = max_peers
+        self.budget = budget or default_budget()
+        self.store = store
+        self.peers = {} #IpPortPair -> PeerInfo
+        self.half_open = {} #IpPortPair -> connector
+        self.factory = PeerProtocol.BTClientFactory(torrent, manager=self)
+        self._timer = None
+
+    def start(self):
+        self.budget.managers.add(self)
+        if self._timer is None:
+            self._timer = reactor.callLater(CONNECT_INTERVAL, self._tick)
+
+    def stop(self):
+        self.budget.managers.discard(self)
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        for connector in list(self.half_open.values()):
+            connector.stopConnecting()
+        for info in self.peers.values():
+            if info.protocol is not None: self._rate(info, info.protocol)
+
+    def _rate(self, info, protocol):
+        elapsed = reactor.seconds() - info.connected_at
+        if elapsed > 0:
+            info.rate = max(info.rate, protocol.payload_down/elapsed)
+        if self.store is not None: self.store.rated(info.addr, info.rate)
+
+    def _tick(self):
+        self._timer = reactor.callLater(CONNECT_INTERVAL, self._tick)
+        self.connect_peers()
+
+    def peer_count(self):
+        return len(self._torrent.current_protocols)
+
+    def add_peers(self, addrs):
+        for addr in addrs:
+            if addr not in self.peers:
+                self.peers[addr] = PeerInfo(addr)
+
+    def add_known_peer(self, addr, rate):
+        """peer which gave us rate bytes/s in an earlier run"""
+        info = self.peers.get(addr)
+        if info is None:
+            info = self.peers[addr] = PeerInfo(addr)
+        info.rate = max(info.rate, rate)
+
+    def accept_incoming(self):
+        """whether an incoming connection fits into limits"""
+        return (self.peer_count() + len(self.half_open) < self.max_peers and
+                self.budget.peers() + self.budget.half_open() < self.budget.max_peers)
+
+    def connect_peers(self):
+        t = self._torrent
+        if not t.running or t.finished(): return
+        n = min(self.max_peers - self.peer_count() - len(self.half_open),
+                self.budget.free_slots())
+        if n <= 0: return
+        now = reactor.seconds()
+        candidates = [info for info in self.peers.values()
+                      if info.protocol is None and info.addr not in self.half_open
+                      and info.next_try <= now]
+        candidates.sort(key=PeerInfo.score, reverse=True)
+        for info in candidates[:n]:
+            self.half_open[info.addr] = reactor.connectTCP(
+                info.addr.ip, info.addr.port, self.factory, timeout=CONNECT_TIMEOUT)
+
+    def _failed(self, info):
+        info.failures += 1
+        if info.failures > MAX_FAILURES:
+            del self.peers[info.addr]
+            return
+        info.next_try = reactor.seconds() + min(BACKOFF*2**(info.failures-1), MAX_BACKOFF)
+
+    def connect_failed(self, addr):
+        """called by factory when connect timed out or was refused"""
+        self.half_open.pop(addr, None)
+        if self.store is not None: self.store.failed(addr)
+        info = self.peers.get(addr)
+        if info is not None: self._failed(info)
+
+    def connected(self, addr, protocol):
+        """called by protocol once TCP connection is made"""
+        self.half_open.pop(addr, None)
+        info = self.peers.get(addr)
+        if info is None:
+            info = self.peers[addr] = PeerInfo(addr)
+        info.protocol = protocol
+        info.connected_at = reactor.seconds()
+        self._torrent.connections.add(addr)
+
+    def handshaked(self, addr):
+        """called by protocol once peer's handshake is accepted"""
+        if self.store is not None: self.store.connected(addr)
+
+    def disconnected(self, addr, protocol):
+        self.half_open.pop(addr, None)
+        self._torrent.connections.discard(addr)
+        info = self.peers.get(addr)
+        if info is None: return
+        info.protocol = None
+        if protocol.state != PeerProtocol.BTProtocolStates.connected:
+            #closed before handshake
+            if self.store is not None: self.store.failed(addr)
+            self._failed(info)
+            return
+        self._rate(info, protocol)
+        if protocol.payload_down:
+            info.failures = 0
+        info.next_try = reactor.seconds() + RECONNECT_DELAY
+        logging.debug("Peer %s scored %.0f", addr, info.score())
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+import RateLimit
+from aux import IpPortPair
+from dtoc_exceptions import DTOCFailure
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.dtoc', 'dtocd.sock')
+
+#JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class Control(object):
+    """Methods of control API. Torrents are addressed by hex info_hash."""
+    def __init__(self, session):
+        self.session = session
+
+    def _torrent(self, info_hash):
+        try:
+            return self.session.torrents[bytes.fromhex(info_hash)]
+        except (KeyError, ValueError, TypeError):
+            raise RPCError(INVALID_PARAMS, "Unknown torrent %r" % info_hash)
+
+    def add(self, path, save_path="./", paused=False, **options):
+        """options are passed to Torrent, e.g. storage or max_peers"""
+        t = self.session.add_torrent(path, save_path, paused, **options)
+        return t.info_hash_str
+
+    def remove(self, info_hash):
+        t = self._torrent(info_hash)
+        self.session.remove_torrent(t.info_hash)
+        return True
+
+    def pause(self, info_hash):
+        self.session.pause(self._torrent(info_hash).info_hash)
+        return True
+
+    def resume(self, info_hash):
+        self.session.resume(self._torrent(info_hash).info_hash)
+        return True
+
+    def add_peers(self, info_hash, peers):
+        """peers is a list of [ip, port]"""
+        t = self._torrent(info_hash)
+        t.peer_list_update({IpPortPair(ip, int(port)) for ip, port in peers})
+        return True
+
+    def reannounce(self, info_hash):
+        self._torrent(info_hash).announcer.reannounce()
+        return True
+
+    def list(self):
+        return [self.stats(t.info_hash_str) for t in self.session.torrents.values()]
+
+    def stats(self, info_hash):
+        t = self._torrent(info_hash)
+        stats = t.stats()
+        stats['state'] = self.session.state(t.info_hash)
+        return stats
+
+    def files(self, info_hash):
+        t = self._torrent(info_hash)
+        return [{'path': f.path, 'length': f.length, 'priority': t.file_priority[i]}
+                for i, f in enumerate(t.files)]
+
+    def set_file_priority(self, info_hash, file_index, priority):
+        t = self._torrent(info_hash)
+        if not 0 <= file_index < len(t.files):
+            raise RPCError(INVALID_PARAMS, "Invalid file index %r" % file_index)
+        t.set_file_priority(file_index, priority)
+        return True
+
+    def set_limits(self, upload=None, download=None, info_hash=None, cls=RateLimit.PEER):
+        """rates in bytes per second, 0 is unlimited. Without info_hash
+           limits of class cls of whole session are set.
+        """
+        if info_hash is None:
+            if cls not in RateLimit.CLASSES:
+                raise RPCError(INVALID_PARAMS, "Unknown limit class %r" % cls)
+            self.session.limits.set_limits(cls, upload, download)
+            return True
+        t = self._torrent(info_hash)
+        if upload is not None: t.up_bucket.set_rate(upload)
+        if download is not None: t.down_bucket.set_rate(download)
+        return True
+
+    def set_max_active(self, n):
+        if not isinstance(n, int) or isinstance(n, bool) or n < 0:
+            raise RPCError(INVALID_PARAMS, "max_active should be a non-negative integer")
+        self.session.max_active = n
+        self.session._schedule()
+        return True
+
+    def session_stats(self):
+        s = self.session
+        return {
+            'port': s.port,
+            'torrents': len(s.torrents),
+            'max_active': s.max_active,
+            'peers': s.budget.peers(),
+            'half_open': s.budget.half_open(),
+            'disk_pending': s.disk.pending,
+        }
+
+    def shutdown(self):
+        reactor.callLater(0, reactor.stop)
+        return True
+
+    METHODS = ('add', 'remove', 'pause', 'resume', 'add_peers', 'reannounce',
+               'list', 'stats', 'files',
+               'set_file_priority', 'set_limits', 'set_max_active',
+               'session_stats', 'shutdown')
+
+    def call(self, method, params):
+        if method not in self.METHODS:
+            raise RPCError(METHOD_NOT_FOUND, "Method not found: %s" % method)
+        f = getattr(self, method)
+        try:
+            if isinstance(params, dict): return f(**params)
+            return f(*params)
+        except TypeError as e:
+            raise RPCError(INVALID_PARAMS, str(e))
+        except (DTOCFailure, OSError, ValueError, KeyError) as e:
+            raise RPCError(SERVER_ERROR, str(e))
+
+
+class ControlResource(resource.Resource):
+    """JSON-RPC 2.0 over HTTP POST, batches are supported"""
+    isLeaf = True
+
+    def __init__(self, control):
+        super().__init__()
+        self.control = control
+
+    def _handle(self, req):
+        """response to req, None if it is a notification(has no id)"""
+        rid = req.get('id') if isinstance(req, dict) else None
+        notification = False
+        try:
+            if (not isinstance(req, dict) or not isinstance(req.get('method'), str)
+                    or not isinstance(req.get('params', []), (list, dict))):
+                raise RPCError(INVALID_REQUEST, "Invalid request")
+            notification = 'id' not in req
+            result = self.control.call(req['method'], req.get('params', []))
+            if notification: return None
+            return {'jsonrpc': '2.0', 'id': rid, 'result': result}
+        except RPCError as e:
+            if notification: return None
+            return {'jsonrpc': '2.0', 'id': rid,
+                    'error': {'code': e.code, 'message': e.message}}
+        except Exception as e:
+            logging.exception("Control call failed")
+            if notification: return None
+            return {'jsonrpc': '2.0', 'id': rid,
+                    'error': {'code': SERVER_ERROR, 'message': str(e)}}
+
+    def render_POST(self, request):
+        try:
+            req = json.loads(request.content.read())
+        except ValueError:
+            resp = {'jsonrpc': '2.0', 'id': None,
+                    'error': {'code': PARSE_ERROR, 'message': "Parse error"}}
+        else:
+            if isinstance(req, list) and req:
+                resp = [r for r in map(self._handle, req) if r is not None] or None
+            else:
+                #empty batch is an invalid request too
+                resp = self._handle(req)
+        if resp is None:
+            #only notifications, nothing to answer
+            request.setResponseCode(204)
+            return b''
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(resp).encode('utf-8')
+
+
+def listen(session, path=DEFAULT_SOCKET):
+    """serves control API of session on unix socket path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    site = server.Site(ControlResource(Control(session)))
+    return reactor.listenUNIX(path, site, mode=0o600, wantPID=True)
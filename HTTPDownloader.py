@@ -10,6 +10,9 @@ from pprint import pformat
 import math
 from enum import Enum
 
+import RateLimit
+from dtoc_exceptions import DTOCFailure
+
 
 agent = Agent(reactor, pool=HTTPConnectionPool(reactor))
 
@@ -19,28 +22,38 @@ class HTTPDataDownloader(Protocol):
         self.finished = finished
         self.buffer = b''
         self.expected = p.currently_downloading[1]
+        self._limit = RateLimit.Chain(p.torrent.limits.down[RateLimit.HTTP])
 
     def dataReceived(self, data):
         self.buffer += data
         self.expected -= len(data)
+        self._limit.consume(len(data))
+        delay = self._limit.delay()
+        if delay and self.expected > 0:
+            self.transport.pauseProducing()
+            reactor.callLater(delay, self.transport.resumeProducing)
         if self.expected <= 0:
             cd = self.p.currently_downloading
-            if cd[0] == self.p.first:
-                f = self.p.torrent._open_files[self.p.findex]
-                f.seek(0)
-                f.write(self.buffer)
-                self.finished.callback(True)
-            elif cd[0] == self.p.last:
-                f = self.p.torrent._open_files[self.p.findex]
-                f.seek(cd[2])
-                f.write(self.buffer)
-                self.finished.callback(True)
+            torrent = self.p.torrent
+            if cd[0] == self.p.first or cd[0] == self.p.last:
+                #only part of piece belongs to file, it can't be verified
+                begin = self.p.finfo.start + cd[2] - cd[0]*torrent.piece_length
+                d = torrent.disk.submit(torrent.write_block, cd[0], begin, self.buffer)
+                d.addCallbacks(lambda _: True, self._write_failed)
             else:
-                if self.p.torrent.write_piece(cd[0], self.buffer):
-                    self.finished.callback(True)
-                else:
-                    print("Failed")
-                    print(cd)
+                d = torrent.commit_piece(cd[0], self.buffer)
+            d.addCallback(self._committed, cd)
+
+    def _write_failed(self, failure):
+        logging.error("Writing %s failed: %s", self.p.url, failure.getErrorMessage())
+        return False
+
+    def _committed(self, ok, cd):
+        if ok:
+            self.finished.callback(True)
+        else:
+            self.finished.errback(DTOCFailure("Piece %d of %s failed" % (cd[0], self.p.url)))
+
 class HTTPDownloader:
     def __init__(self, torrent, findex, url):
         self.torrent = torrent
@@ -48,10 +61,9 @@ class HTTPDownloader:
         self.url = url
         self.finfo = torrent.files[findex]
         self.session_downloaded = 0
-        self.first = self.finfo.start // torrent.piece_length #first piece
-        self.last = (self.finfo.start + self.finfo.length - 1)//torrent.piece_length #end piece
+        self.first, start_offset, self.last, _ = torrent.file_to_range(findex)
         to_download = None
-        first_piece_data = (self.first+1)*torrent.piece_length - self.finfo.start
+        first_piece_data = torrent.piece_length - start_offset
         if not torrent.bitfield[self.first]:
             to_download = self.first
             if self.first == self.last: expected = self.finfo.length
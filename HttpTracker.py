@@ -1,89 +1,112 @@
-from twisted.web.client import Agent, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
 from twisted.internet import reactor
-from twisted.python import log
 from urllib import parse
-import io
-
+import logging
 
 import dtoc_bencode
-from dtoc_exceptions import DTOCFailure
+from aux import IpPortPair, compact_peers, compact_peers6
+from dtoc_exceptions import HTTPTrackerFailure
+from Tracker import AnnounceResult
+
+NUMWANT = 50
+MAX_PERSISTENT = 2 #idle keep-alive connections per tracker host
+CONNECT_TIMEOUT = 30 #seconds
 
-def  get_peers(agent, url, torrent, event=None, numwant=50,trackerid=None):
+def get_peers(agent, url, torrent, event=None, numwant=NUMWANT, trackerid=None):
+    """sends announce to http tracker, returns Deferred of bdecoded reply"""
     def _handle_response(resp):
+        if resp.code != 200:
+            #body has to be read for connection to go back to pool
+            d = readBody(resp)
+            d.addBoth(_http_error, resp.code)
+            return d
         d = readBody(resp)
         d.addCallback(dtoc_bencode.bdecode)
         return d
 
-    def _handle_error(failure):
-        print(failure)
-        return failure
+    def _http_error(_, code):
+        raise HTTPTrackerFailure("HTTP %d from tracker" % code)
 
     qs = {'info_hash': torrent.info_hash,
           'peer_id': torrent.peer_id,
           'port': torrent.port,
-          'uploaded': torrent.uploaded,
-          'downloaded': torrent.downloaded,
-          'left': torrent.left,
+          'uploaded': torrent.uploaded_session,
+          'downloaded': torrent.downloaded_session,
+          'left': torrent.size - torrent.downloaded,
+          'key': '%08x' % torrent.key,
           'compact': 1,
           'numwant': numwant}
     if event: qs['event'] = event
     if trackerid: qs['trackerid'] = trackerid
     q = parse.urlencode(qs, safe='~')
-    url = '?'.join((url, q)).encode('utf-8')
-    # print(url)
+    url = ('&' if '?' in url else '?').join((url, q)).encode('utf-8')
     d = agent.request(b'GET', url)
-    d.addCallbacks(_handle_response, _handle_error)
+    d.addCallback(_handle_response)
     return d
 
+def parse_peers(data):
+    """peers of announce reply, compact or not, IPv4 and IPv6"""
+    peers = data.get(b'peers', b'')
+    if isinstance(peers, bytes):
+        result = compact_peers(peers)
+    else:
+        result = {IpPortPair(p[b'ip'].decode('utf-8'), p[b'port']) for p in peers}
+    peers6 = data.get(b'peers6', b'')
+    if isinstance(peers6, bytes):
+        result |= compact_peers6(peers6)
+    return result
+
+_default_agent = None
+
+def default_agent():
+    """Agent with keep-alive connection pool shared by all http trackers"""
+    global _default_agent
+    if _default_agent is None:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = MAX_PERSISTENT
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.closeCachedConnections)
+        _default_agent = Agent(reactor, connectTimeout=CONNECT_TIMEOUT, pool=pool)
+    return _default_agent
+
 class HttpTracker(object):
-    def __init__(self, torrent, url):
+    """Announces torrent to http(s) tracker. Scheduling and retries are
+       left to Announcer.Announcer.
+    """
+    def __init__(self, torrent, url, agent=None):
         self._torrent = torrent
         self.url = url
-        self.state = 'init'
         self._tracker_id = None
-        self._agent = Agent(reactor)
+        self._agent = agent
+        self._pending = None
+
+    def announce(self, event=None):
+        """returns Deferred which fires with Tracker.AnnounceResult"""
+        d = self._pending = get_peers(self._agent or default_agent(), self.url,
+                                      self._torrent, event, trackerid=self._tracker_id)
+        d.addBoth(self._done)
+        d.addCallback(self._response_received)
+        return d
 
-    def start(self):
-        if self.state == 'started':
-            return
+    def _done(self, result):
+        self._pending = None
+        return result
 
-    def force_reannounce(self):
-        self._announce()
+    def cancel(self):
+        if self._pending is not None: self._pending.cancel()
 
-    def _response_received(data):
+    def _response_received(self, data):
+        if not isinstance(data, dict):
+            raise HTTPTrackerFailure("Invalid tracker reply")
         if b'failure reason' in data:
-            self.state = 'error'
-            self.error = data[b'failure reason'].decode('utf-8')
-            return
-        self._interval = data[b'interval']
-        self._min_interval = data[b'min interval']
-
+            raise HTTPTrackerFailure(data[b'failure reason'].decode('utf-8', 'replace'))
+        if b'warning message' in data:
+            logging.warning("Tracker %s: %s", self.url,
+                            data[b'warning message'].decode('utf-8', 'replace'))
         if b'tracker id' in data:
             self._tracker_id = data[b'tracker id']
-
-        self.complete = data.get(b'complete')
-        self.incomplete = data.get(b'incomplete')
-
-
-    def _error_occured(data):
-        self.state = 'error'
-        self.error = "HTTP announce failed"
-        reactor.callLater(120, self._announce)
-
-    def _announce(self):
-        d = get_peers(self._agent, self.url, self._torrent, trackerid = self._tracker_id)
-        d.addCallbacks(_response_received, _error_occured)
-
-
-if __name__ == '__main__':
-    a = Agent(reactor)
-    def ppr(data):
-        print("PPR")
-        print(data)
-
-    def dothings():
-        t = Stub_Torrent()
-        d = get_peers(a, 'http://tracker.glotorrents.com:6969/announce',t, 'started')
-        d.addCallbacks(ppr, log.err)
-    reactor.callLater(1, dothings)
-    reactor.run()
+        try:
+            return AnnounceResult(int(data[b'interval']), data.get(b'min interval'),
+                                  data.get(b'complete'), data.get(b'incomplete'),
+                                  parse_peers(data))
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPTrackerFailure("Invalid tracker reply: %r" % e)
@@ -6,6 +6,7 @@ import math
 
 from aux import MsgCache
 import PeerProtocol
+import Picker
 
 MULTICAST_IP = "239.5.10.15"
 MULTICAST_PORT = 8691
@@ -106,11 +107,11 @@ class LNDPProtocol:
         reactor.connectTCP(addr[0], port[0], self.client_factory)
 
     def _update_queues(self):
-        self.torrent.queue[1].update(self.torrent.queue[0])
-        self.torrent.queue[0] = set()
+        picker = self.torrent.picker
+        for piece_no in picker.pieces_with_priority(Picker.HIGHEST):
+            picker.set_priority(piece_no, Picker.HIGHEST+1)
         ub = math.ceil((len(self.torrent.pieces) - self.id)/self.swarm_size)
         for i in range(ub):
             piece_no = self.swarm_size*i + self.id
-            self.torrent.queue[0].add(piece_no)
-            for q in self.torrent.queue[1:-1]:
-                if piece_no in q: q.remove(piece_no)
+            if picker.priority[piece_no] != Picker.DONT_DOWNLOAD:
+                picker.set_priority(piece_no, Picker.HIGHEST)
@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import dtoc_bencode
+import aux
+
+
+class Metainfo(object):
+    """Contents of a .torrent file. Nothing here touches the payload on
+       disk or needs twisted, so it is cheap enough for inspection.
+
+       files is a list of (path components, length, md5sum) relative to
+       the directory torrent is saved in. announce_tiers are tracker urls
+       by tier(BEP 12), announce alone makes a single tier.
+    """
+    def __init__(self, bdecoded):
+        info = bdecoded[b'info']
+        self.announce = bdecoded.get(b'announce', b'').decode('utf-8')
+        self.announce_tiers = [[url.decode('utf-8') for url in tier]
+                               for tier in bdecoded.get(b'announce-list', []) if tier]
+        if not self.announce_tiers and self.announce:
+            self.announce_tiers = [[self.announce]]
+        info_hash = hashlib.sha1(dtoc_bencode.bencode(info))
+        self.info_hash = info_hash.digest()
+        self.info_hash_str = info_hash.hexdigest()
+        self.name = info[b'name'].decode('utf-8')
+        self.piece_length = info[b'piece length']
+        temp = info[b'pieces']
+        self.pieces = [temp[i*20:i*20+20] for i in range(len(temp)//20)]
+        files = info.get(b'files', None)
+        if files:
+            self.file_mode = 'multi'
+            self.files = [(tuple([self.name] + [s.decode('utf-8') for s in f[b'path']]),
+                           int(f[b'length']), f.get(b'md5sum', None))
+                          for f in files]
+        else:
+            self.file_mode = 'single'
+            self.files = [((self.name,), int(info[b'length']), info.get(b'md5sum', None))]
+        self.size = sum(f[1] for f in self.files)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            return cls(dtoc_bencode.bdecode(f.read()))
+
+    def file_metadata(self, save_path):
+        """aux.FileMetaData of every file when saved in save_path"""
+        result = []
+        offset = 0
+        for path, length, md5 in self.files:
+            result.append(aux.FileMetaData(os.path.join(save_path, *path),
+                                           length, md5, offset))
+            offset += length
+        return result
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'info_hash': self.info_hash_str,
+            'size': self.size,
+            'piece_length': self.piece_length,
+            'pieces': len(self.pieces),
+            'files': len(self.files),
+            'announce': self.announce_tiers,
+        }
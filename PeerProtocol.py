@@ -1,4 +1,7 @@
 import struct
+import math
+import time
+from collections import OrderedDict, deque
 from twisted.internet.protocol import Protocol, Factory, ClientFactory
 from twisted.internet import reactor
 import bitarray
@@ -6,31 +9,47 @@ from enum import Enum
 import logging
 
 import dtoc_bencode
-
-REQUEST_PIECE_SIZE = 0X4000
+from aux import IpPortPair
+import Picker
+import RateLimit
+
+REQUEST_PIECE_SIZE = Picker.BLOCK_SIZE
+MIN_REQUESTS = 4
+MAX_REQUESTS = 250
+REQUEST_QUEUE_TIME = 2 #seconds of data to keep requested
+COMPACT_THRESHOLD = 0x10000 #consumed bytes after which receive buffer is compacted
+SMALL_WRITE = 0x400 #parts shorter than this are framed into a shared buffer
+TICK_INTERVAL = 5 #seconds between timeout checks of a connection
+REQUEST_TIMEOUT = 30 #seconds before a single request is given to someone else
+SNUB_TIME = 60 #seconds without any block while requests are pending
+KEEP_ALIVE_INTERVAL = 90 #seconds of silence after which keep-alive is sent
+IDLE_TIMEOUT = 180 #seconds without receiving anything before disconnecting
+HANDSHAKE_HEADER = b'\x13BitTorrent protocol'
+_length_prefix = struct.Struct('>I')
 
 class BTProtocolStates(Enum):
     handshake_sent = 1
     connected = 2
 
 class BTClientFactory(ClientFactory):
-    def __init__(self, torrent, lndp=False):
+    def __init__(self, torrent, lndp=False, manager=None):
         self.torrent = torrent
         self._lndp = lndp
+        self._manager = manager #Connections.ConnectionManager
 
     def buildProtocol(self, addr):
         p = BTProtocol(self.torrent)
         p.addr = addr
         p.type = 0 #outgoing
         p._is_lndp = self._lndp
+        p._manager = self._manager
         return p
 
     def clientConnectionFailed(self, connector, reason):
         # if self.torrent.verbose > 10: print(self.torrent.name, "Lost Failed")
+        if self._manager is None: return
         d = connector.getDestination()
-        addr = (d.host, d.port)
-        if addr in self.torrent.peers:
-            self.torrent.peers.remove(addr)
+        self._manager.connect_failed(IpPortPair(d.host, d.port))
 
     def clientConnectionLost(self, connector, reason):
         if self.torrent.verbose > 10: print(self.torrent.name, "Lost connection", reason)
@@ -41,82 +60,284 @@ class BTProtocolFactory(Factory):
         self.torrent = torrent
 
     def buildProtocol(self, addr):
+        if not self.torrent.conn_manager.accept_incoming():
+            return None
         p = BTProtocol(self.torrent)
         p.addr = addr
         p.type = 1 #incoming
         return p
 
+class BTSessionFactory(Factory):
+    """Incoming connections of a Session.Session, protocol finds its
+       torrent by info_hash of peer's handshake.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def buildProtocol(self, addr):
+        p = BTProtocol(session=self.session)
+        p.addr = addr
+        p.type = 1 #incoming
+        return p
+
 class BTProtocol(Protocol):
-    def __init__(self, torrent):
-        self._torrent = torrent
-        self._buffer_piece = b''
-        self._buffer_block = b''
-        self._buffer_msg = b''
-        self._current_index = None #cached block
-        self._current_request = None
-        self._currently_downloading_block = None #the block we are currently downloading
+    def __init__(self, torrent=None, session=None):
+        self._torrent = None
+        self._session = session
+        self._rbuf = bytearray() #receive buffer, parsed up to _rpos
+        self._rpos = 0
+        self._out = [] #outgoing parts, small ones framed into bytearrays
+        self._flush_call = None
+        self._requests = OrderedDict() #(index, begin) -> (length, time sent)
+        self.download_rate = 0.0 #bytes per second of blocks
+        self._rate_bytes = 0
+        self._rate_time = time.time()
         self.am_choking = True
         self.am_ineterested = False
         self.peer_choking = True
         self.peer_interested = False
-        self.peer_bitfield = set()
         self.state = None
         self.type = None #incoming:1 or outgoing:0 set by factory
         self.downloaded = 0 #reset every 2 seconds for mor accurate speed
+        self.payload_down = 0 #block bytes received, used by choker
+        self.payload_up = 0 #block bytes sent
+        self._is_lndp = False
+        self._manager = None #set for connections opened by ConnectionManager
+        self._paused = set() #reasons reading from transport is paused
+        self._resume_call = None
+        self._upload_queue = deque() #(index, begin, length) requested by peer
+        self._upload_call = None
+        self._timer = None
+        self.snubbed = False
+        self._last_received = self._last_sent = time.time()
+        self._waiting_since = None #last block or first request of pipeline
+        self._up_chain = self._down_chain = RateLimit.Chain()
+        if torrent is not None: self._attach(torrent)
+
+    def _attach(self, torrent):
+        self._torrent = torrent
+        self.peer_bitfield = bitarray.bitarray(len(torrent.pieces))
+        self.peer_bitfield.setall(0)
 
     def connectionMade(self):
+        #incoming connection of a session waits for handshake to know torrent
+        if self._torrent is not None: self._start()
+
+    def _start(self):
         self._send_handshake()
         self._torrent.current_protocols.add(self)
+        if self._manager is not None:
+            self._manager.connected(IpPortPair(self.addr.host, self.addr.port), self)
+        self._make_rate_chains()
+        self._torrent.disk.register(self)
+        self._timer = reactor.callLater(TICK_INTERVAL, self._tick)
         logging.info("Connection made with %s"%self.addr)
 
+    def _make_rate_chains(self):
+        """LAN peers go through LAN class only, others through
+           torrent and session limits
+        """
+        t = self._torrent
+        self.up_bucket = RateLimit.TokenBucket(t.peer_upload_limit)
+        self.down_bucket = RateLimit.TokenBucket(t.peer_download_limit)
+        if self._is_lndp:
+            self._up_chain = RateLimit.Chain(self.up_bucket, t.limits.up[RateLimit.LAN])
+            self._down_chain = RateLimit.Chain(self.down_bucket, t.limits.down[RateLimit.LAN])
+        else:
+            self._up_chain = RateLimit.Chain(self.up_bucket, t.up_bucket,
+                                             t.limits.up[RateLimit.PEER])
+            self._down_chain = RateLimit.Chain(self.down_bucket, t.down_bucket,
+                                               t.limits.down[RateLimit.PEER])
+
+    def _pause(self, reason):
+        if not self._paused: self.transport.pauseProducing()
+        self._paused.add(reason)
+
+    def _resume(self, reason):
+        if reason not in self._paused: return
+        self._paused.discard(reason)
+        if not self._paused: self.transport.resumeProducing()
+
+    def pauseProducing(self):
+        """called by DiskQueue"""
+        self._pause('disk')
+
+    def resumeProducing(self):
+        self._resume('disk')
+
+    def _rate_resume(self):
+        self._resume_call = None
+        self._resume('rate')
+        self.do_download()
+
+    def _write(self, *parts):
+        """Queues parts of a message. Everything queued in one reactor
+           tick is flushed with a single writeSequence.
+        """
+        out = self._out
+        for part in parts:
+            if len(part) < SMALL_WRITE:
+                if not out or type(out[-1]) is not bytearray:
+                    out.append(bytearray())
+                out[-1] += part
+            else:
+                out.append(part)
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        if not self._out: return
+        out, self._out = self._out, []
+        self._last_sent = time.time()
+        self.transport.writeSequence([p if type(p) is bytes else bytes(p) for p in out])
+
     def connectionLost(self, reason):
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        self._out = []
+        for call in (self._resume_call, self._upload_call, self._timer):
+            if call is not None and call.active(): call.cancel()
+        self._resume_call = self._upload_call = self._timer = None
+        self._upload_queue.clear()
+        if self._torrent is None: return
         self._torrent.current_protocols.remove(self)
+        if self._manager is not None:
+            self._manager.disconnected(IpPortPair(self.addr.host, self.addr.port), self)
+        self._torrent.disk.unregister(self)
+        self._torrent.picker.peer_lost(self.peer_bitfield)
+        self._torrent.choker.peer_lost(self)
+        self._torrent.scheduler.release(self, list(self._requests))
+        self._requests.clear()
         logging.warn("Connection lost with %s"%self.addr)
 
     def dataReceived(self, data):
+        """Messages are parsed in place with memoryviews of receive
+           buffer. Handlers must copy whatever they keep.
+        """
         self.downloaded += len(data)
-        self._buffer_msg += data
-        while True:
-            if self.state == BTProtocolStates.connected:
-                if len(self._buffer_msg) < 4:
-                    break
-                l, *_ = struct.unpack_from('>I', self._buffer_msg)
-                if len(self._buffer_msg) < 4+l: break
-                msg = self._buffer_msg[4:4+l]
-                self._buffer_msg = self._buffer_msg[4+l:]
-                self._call_msg_handler(msg)
-            elif self.state == BTProtocolStates.handshake_sent:
-                if len(self._buffer_msg) < 68:
-                    break
-                if not self._buffer_msg.startswith(b'\x13BitTorrent protocol'):
-                    self.transport.loseConnection()
+        self._last_received = time.time()
+        self._down_chain.consume(len(data))
+        buf = self._rbuf
+        buf += data
+        pos = self._rpos
+        view = memoryview(buf)
+        msg = None
+        try:
+            while True:
+                avail = len(buf) - pos
+                if self.state == BTProtocolStates.connected:
+                    if avail < 4:
+                        break
+                    l, = _length_prefix.unpack_from(buf, pos)
+                    if avail < 4+l: break
+                    msg = view[pos+4:pos+4+l]
+                    pos += 4+l
+                    self._call_msg_handler(msg)
+                elif self.state == BTProtocolStates.handshake_sent or self._torrent is None:
+                    if avail < 68:
+                        break
+                    if view[pos:pos+20] != HANDSHAKE_HEADER:
+                        self.transport.loseConnection()
+                        break
+                    msg = bytes(view[pos:pos+68])
+                    pos += 68
+                    if self._torrent is None and not self._route(msg): break
+                    self._handle_handshake(msg)
+                else:
                     break
-                msg = self._buffer_msg[:68]
-                self._buffer_msg = self._buffer_msg[68:]
-                self._handle_handshake(msg)
-
-    def do_download(self, index=None):
-        if self.peer_choking == True: return
-        if index is None or index < 0 or index >= len(self._torrent.pieces):
-            index = self._torrent.give_me_order(self.peer_bitfield)
-        if index is None:
-            self._currently_downloading_block = None
+        finally:
+            msg = None
+            view.release()
+        if pos == len(buf):
+            buf.clear()
+            pos = 0
+        elif pos >= COMPACT_THRESHOLD:
+            del buf[:pos]
+            pos = 0
+        self._rpos = pos
+        delay = self._down_chain.delay()
+        if delay and 'rate' not in self._paused:
+            self._pause('rate')
+            self._resume_call = reactor.callLater(delay, self._rate_resume)
+
+    def do_download(self):
+        """fills request pipeline up to desired queue depth"""
+        if self.peer_choking == True or 'rate' in self._paused: return
+        n = self.desired_queue() - len(self._requests)
+        if n <= 0: return
+        for block in self._torrent.scheduler.request_blocks(self, n):
+            self._send_request(*block)
+
+    def desired_queue(self):
+        """enough requests for REQUEST_QUEUE_TIME seconds at current
+           download rate, just one for a snubbed peer. Time a request
+           takes includes waiting behind the ones before it, so it would
+           only ever deepen the queue and is not used.
+        """
+        if self.snubbed: return 1
+        n = self.download_rate*REQUEST_QUEUE_TIME/REQUEST_PIECE_SIZE
+        return max(MIN_REQUESTS, min(MAX_REQUESTS, math.ceil(n)))
+
+    def _update_rate(self, n):
+        self._rate_bytes += n
+        now = time.time()
+        if now - self._rate_time >= 1:
+            rate = self._rate_bytes/(now - self._rate_time)
+            self.download_rate = 0.6*self.download_rate + 0.4*rate
+            self._rate_bytes = 0
+            self._rate_time = now
+
+    def _tick(self):
+        self._timer = reactor.callLater(TICK_INTERVAL, self._tick)
+        now = time.time()
+        if now - self._last_received > IDLE_TIMEOUT:
+            logging.info("Idle connection with %s", self.addr)
+            self.transport.loseConnection()
             return
-        target_piece_size = self._torrent.length_of_piece(index)
-        offset = 0
-        length = min(REQUEST_PIECE_SIZE, target_piece_size)
-        self._currently_downloading_block = index
-        self._send_request(index, offset, length)
+        if now - self._last_sent > KEEP_ALIVE_INTERVAL:
+            self._send_keep_alive()
+        if not self._requests: return
+        if not self.snubbed and now - self._waiting_since > SNUB_TIME:
+            logging.info("%s snubbed us", self.addr)
+            self.snubbed = True
+            self._drop_requests(list(self._requests))
+        else:
+            #requests are ordered by time sent
+            stale = []
+            for key, (length, sent) in self._requests.items():
+                if now - sent < REQUEST_TIMEOUT: break
+                stale.append(key)
+            if stale: self._drop_requests(stale)
+        self.do_download()
+
+    def _drop_requests(self, keys):
+        """cancels requests and hands their blocks to other peers"""
+        for key in keys:
+            length, _ = self._requests.pop(key)
+            self._send_cancel(key[0], key[1], length)
+        self._torrent.scheduler.release(self, keys)
+        for protocol in list(self._torrent.current_protocols):
+            if protocol is not self: protocol.do_download()
 
     def _send_handshake(self):
         reserved = bytearray(b'\x00'*8)
         reserved[5] |= 0x10
-        self.transport.write(b'\x13BitTorrent protocol')
-        self.transport.write(reserved)
-        self.transport.write(self._torrent.info_hash)
-        self.transport.write(self._torrent.peer_id)
+        self._write(HANDSHAKE_HEADER + reserved + self._torrent.info_hash +
+                    self._torrent.peer_id)
         self.state = BTProtocolStates.handshake_sent
 
+    def _route(self, handshake):
+        """attaches incoming connection to torrent of session"""
+        torrent = self._session.route(handshake[28:48])
+        if torrent is None:
+            self.transport.loseConnection()
+            return False
+        self._attach(torrent)
+        self._start()
+        return True
+
     def _handle_handshake(self, packet):
         """Assume packet is valid"""
         if packet[28:48] != self._torrent.info_hash:
@@ -130,6 +351,8 @@ class BTProtocol(Protocol):
         if (packet[25] & 0x10) and self.type == 0:
             self._send_ltep_handshake()
         self.state = BTProtocolStates.connected
+        if self._manager is not None:
+            self._manager.handshaked(IpPortPair(self.addr.host, self.addr.port))
         self._send_bitfield()
         self._send_intereseted()
 
@@ -143,54 +366,59 @@ class BTProtocol(Protocol):
         5 : '_handle_bitfield',
         6 : '_handle_request',
         7 : '_handle_piece',
-        8 : '_handle_cancle',
+        8 : '_handle_cancel',
         20: '_handle_ltep'
     }
 
     def _call_msg_handler(self, msg):
-        msg_id = struct.unpack_from('>B', msg)[0] if msg else -1
+        msg_id = msg[0] if msg else -1
         payload = msg[1:] if msg else None
         getattr(self, self.id_to_method[msg_id])(payload)
 
     def _send_keep_alive(self):
-        self.transport.write(b'\x00\x00\x00\x00')
+        self._write(b'\x00\x00\x00\x00')
 
     def _send_choke(self):
         self.am_choking = True
-        self.transport.write(b'\x00\x00\x00\x01\x00')
+        self._upload_queue.clear() #choked peer knows its requests are dropped
+        self._write(b'\x00\x00\x00\x01\x00')
 
     def _send_unchoke(self):
         self.am_choking = False
-        self.transport.write(b'\x00\x00\x00\x01\x01')
+        self._write(b'\x00\x00\x00\x01\x01')
 
     def _send_intereseted(self):
         self.am_ineterested = True
-        self.transport.write(b'\x00\x00\x00\x01\x02')
+        self._write(b'\x00\x00\x00\x01\x02')
 
     def _send_not_interested(self):
         self.am_ineterested = False
-        self.transport.write(b'\x00\x00\x00\x01\x03')
+        self._write(b'\x00\x00\x00\x01\x03')
 
     def _send_have(self, index):
-        self.transport.write(b'\x00\x00\x00\x05\x04')
-        self.transport.write(struct.pack('>I', index))
+        self._write(struct.pack('>IBI', 5, 4, index))
 
     def _send_bitfield(self):
         bytes_ = self._torrent.bitfield.tobytes()
-        self.transport.write(struct.pack('>I', len(bytes_)+1))
-        self.transport.write(b'\x05')
-        self.transport.write(bytes_)
+        self._write(struct.pack('>IB', len(bytes_)+1, 5), bytes_)
 
     def _send_request(self, index, begin, length=REQUEST_PIECE_SIZE):
-        self.transport.write(b'\x00\x00\x00\x0D\x06')
-        self.transport.write(struct.pack('>III', index, begin, length))
-        self._current_request = (index, begin, length)
+        self._write(struct.pack('>IBIII', 13, 6, index, begin, length))
+        now = time.time()
+        if not self._requests: self._waiting_since = now
+        self._requests[(index, begin)] = (length, now)
+
+    def _send_cancel(self, index, begin, length):
+        self._write(struct.pack('>IBIII', 13, 8, index, begin, length))
 
     def _handle_keep_alive(self, payload=None):
         pass
 
     def _handle_choke(self, payload=None):
         self.peer_choking = True
+        #peer drops our pending requests when it chokes us
+        self._torrent.scheduler.release(self, list(self._requests))
+        self._requests.clear()
 
     def _handle_unchoke(self, payload=None):
         self.peer_choking = False
@@ -198,21 +426,28 @@ class BTProtocol(Protocol):
 
     def _handle_interested(self, payload=None):
         self.peer_interested = True
-        if self.am_choking: self._send_unchoke()
+        self._torrent.choker.peer_interested(self)
 
     def _handle_not_ineteresetd(self, payload=None):
         self.peer_interested = False
 
     def _handle_have(self, payload):
-        b = struct.unpack('>I', payload)
-        self.peer_bitfield.add(b[0])
-        if self._currently_downloading_block is None:
-            self.do_download()
+        index, = struct.unpack('>I', payload)
+        if index >= len(self.peer_bitfield): return
+        if not self.peer_bitfield[index]:
+            self.peer_bitfield[index] = True
+            self._torrent.picker.inc(index)
+        self.do_download()
 
     def _handle_bitfield(self, payload):
+        n = len(self._torrent.pieces)
         ba = bitarray.bitarray(endian="big")
-        ba.frombytes(payload)
-        self.peer_bitfield = set(i for i, e in enumerate(ba) if e)
+        ba.frombytes(bytes(payload))
+        if len(ba) < n: ba.extend([False]*(n - len(ba)))
+        del ba[n:]
+        self._torrent.picker.peer_lost(self.peer_bitfield)
+        self.peer_bitfield = ba
+        self._torrent.picker.peer_bitfield(ba)
         self.do_download()
 
     def _handle_request(self, payload):
@@ -221,39 +456,78 @@ class BTProtocol(Protocol):
                 self.am_choking or
                 length > REQUEST_PIECE_SIZE or
                 length <= 0 or
-                begin >= self._torrent.piece_length
+                begin >= self._torrent.piece_length or
+                index >= len(self._torrent.pieces) or
+                not self._torrent.bitfield[index]
         ):
             return
-        if self._current_index != index:
-            self._current_piece = self._torrent.read_piece(index)
-            self._current_index = index
-        self.transport.write(struct.pack('>IBII', 9+length, 7, index, begin))
-        self.transport.write(self._current_piece[begin:begin+length])
+        self._upload_queue.append((index, begin, length))
+        if self._upload_call is None: self._serve_uploads()
+
+    def _serve_uploads(self):
+        """sends queued blocks as long as upload limits allow"""
+        self._upload_call = None
+        while self._upload_queue:
+            delay = self._up_chain.delay()
+            if delay:
+                self._upload_call = reactor.callLater(delay, self._serve_uploads)
+                return
+            index, begin, length = self._upload_queue.popleft()
+            block = self._torrent.read_upload_block(index, begin, length)
+            self._up_chain.consume(len(block))
+            self.payload_up += len(block)
+            self._torrent.uploaded_session += len(block)
+            self._write(struct.pack('>IBII', 9+len(block), 7, index, begin), block)
 
     def _handle_piece(self, payload):
         index, begin = struct.unpack_from('>II', payload)
-        if self._current_request != (index, begin, len(payload)-8):
-            self._send_request(*self._current_request)
-
-        target_piece_size = self._torrent.length_of_piece(self._currently_downloading_block)
-        self._buffer_piece += payload[8:]
-        if len(self._buffer_piece) != target_piece_size:
-            nr = self._currently_downloading_block
-            offset = len(self._buffer_piece)
-            length = min(REQUEST_PIECE_SIZE, target_piece_size - offset)
-            self._send_request(nr, offset, length)
-        elif self._torrent.write_piece(self._currently_downloading_block, self._buffer_piece):
-            self._buffer_piece = b''
-            for protocol in self._torrent.current_protocols:
-                protocol._send_have(index)
-            logging.info("\nDownloaded %d from %s" % (self._currently_downloading_block, self.transport.getPeer()))
-            self.do_download()
+        data = payload[8:]
+        req = self._requests.pop((index, begin), None)
+        if req is None:
+            return #not requested or cancelled by endgame
+        if req[0] != len(data):
+            #block goes to someone else
+            self._torrent.scheduler.release(self, [(index, begin)])
+            return
+        self.payload_down += len(data)
+        self._waiting_since = time.time()
+        self.snubbed = False
+        self._update_rate(len(data))
+        pp = self._torrent.scheduler.block_received(self, index, begin, data)
+        if pp is not None:
+            d = self._torrent.commit_piece(index, pp.buffer)
+            d.addCallback(self._piece_committed, index)
+            d.addErrback(logging.error)
+        self.do_download()
+
+    def _piece_committed(self, ok, index):
+        if ok:
+            self._torrent.broadcast_have(index)
+            logging.info("\nDownloaded %d from %s" % (index, self.addr))
         else:
-            self._buffer_piece = b''
             print("Block download failed")
-            #TODO: RESTART DOWNLOADING THIS BLOCK AGAIN
+        if self in self._torrent.current_protocols:
+            self.do_download()
+        if self._torrent.picker.in_endgame():
+            #idle peers may help with remaining pieces
+            for protocol in list(self._torrent.current_protocols):
+                if not protocol._requests: protocol.do_download()
+
+    def _cancel_block(self, index, begin, length):
+        """Block arrived from another peer in endgame."""
+        if self._requests.pop((index, begin), None) is not None:
+            self._send_cancel(index, begin, length)
+            self.do_download()
+
+    def _handle_cancel(self, payload):
+        index, begin, length = struct.unpack('>III', payload)
+        try:
+            self._upload_queue.remove((index, begin, length))
+        except ValueError:
+            pass #already sent
 
     def _handle_ltep(self, payload=None):
+        payload = bytes(payload)
         if payload[0] == 0:
             self._handle_ltep_handshake(payload[1:])
         if payload[0] == 1:
@@ -266,23 +540,21 @@ class BTProtocol(Protocol):
         else:
             msg_d = {'m':{'dt_lndp': 1}}
         msg = dtoc_bencode.bencode(msg_d)
-        self.transport.write(struct.pack('>I', len(msg)+2))
-        self.transport.write(b'\x14\x00')
-        self.transport.write(msg)
+        self._write(struct.pack('>IBB', len(msg)+2, 20, 0), msg)
 
     def send_ltep(self, msg_protocol, payload):
         msg_id = self.peer_ltep.get(msg_protocol, -1)
         if msg_id == -1: raise Exception("No support for ltep %s"%msg_protocol)
-        self.transport.write(struct.pack('>I', len(payload)+2))
-        self.transport.write(b'\x14')
-        self.transport.write(struct.pack('>B', msg_id))
-        self.transport.write(payload)
+        self._write(struct.pack('>IBB', len(payload)+2, 20, msg_id), payload)
 
     def _handle_ltep_handshake(self, msg):
         if self.type == 1: self._send_ltep_handshake()
         msg = dtoc_bencode.bdecode(msg)
         self.peer_ltep = {k.decode('utf-8'):int(v) for k,v in msg[b'm'].items()}
         if self.type == 1 and 'dt_lndp' in self.peer_ltep:
+            #LAN peer which connected to us, its traffic is LAN class now
+            self._is_lndp = True
+            self._make_rate_chains()
             self._torrent.lndp.send_handshake(self)
 
     def _handle_invalid(self, payload=None):
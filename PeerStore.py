@@ -0,0 +1,137 @@
+import os
+import socket
+import struct
+import logging
+import time
+
+import dtoc_bencode
+from aux import IpPortPair
+from dtoc_exceptions import BencodeFailure
+
+MAX_STORED_PEERS = 1000 #per torrent
+MAX_FAILURES = 8 #peer which never worked is forgotten after these many
+PEER_TTL = 14*24*3600 #seconds, peers not seen for longer are forgotten
+
+_port = struct.Struct('>H')
+
+def pack_peer(addr):
+    """IpPortPair to 6(IPv4) or 18(IPv6) bytes, as in compact peer lists"""
+    family = socket.AF_INET6 if ':' in addr.ip else socket.AF_INET
+    return socket.inet_pton(family, addr.ip) + _port.pack(addr.port)
+
+def unpack_peer(key):
+    family = socket.AF_INET6 if len(key) == 18 else socket.AF_INET
+    return IpPortPair(socket.inet_ntop(family, key[:-2]), _port.unpack(key[-2:])[0])
+
+def peer_path(store_dir, info_hash_str):
+    return os.path.join(store_dir, info_hash_str + '.peers')
+
+
+class PeerRecord(object):
+    __slots__ = ('last_seen', 'successes', 'failures', 'rate')
+
+    def __init__(self, last_seen=0, successes=0, failures=0, rate=0):
+        self.last_seen = last_seen
+        self.successes = successes
+        self.failures = failures #in a row
+        self.rate = rate #best payload bytes/s downloaded
+
+    def rank(self):
+        return (self.successes > 0, self.rate, -self.failures, self.last_seen)
+
+
+class PeerStore(object):
+    """Peers of a torrent keyed by packed address, with when they were
+       last seen and how connecting to them went. Kept between runs in
+       path so that a restarted torrent can reconnect to peers which
+       worked before any tracker answers.
+    """
+    def __init__(self, path=None, max_peers=MAX_STORED_PEERS):
+        self.path = path
+        self.max_peers = max_peers
+        self.peers = {} #packed address -> PeerRecord
+        self._dirty = False
+        if path is not None: self.load()
+
+    def _record(self, addr):
+        """record of addr, None if addr is not a literal ip address"""
+        try:
+            key = pack_peer(addr)
+        except (OSError, ValueError):
+            logging.debug("Bad peer address %r", addr)
+            return None
+        rec = self.peers.get(key)
+        if rec is None:
+            rec = self.peers[key] = PeerRecord()
+        self._dirty = True
+        return rec
+
+    def seen(self, addrs):
+        """addresses got from a tracker or another peer"""
+        now = int(time.time())
+        for addr in addrs:
+            rec = self._record(addr)
+            if rec is not None: rec.last_seen = now
+
+    def connected(self, addr):
+        rec = self._record(addr)
+        if rec is None: return
+        rec.last_seen = int(time.time())
+        rec.successes += 1
+        rec.failures = 0
+
+    def rated(self, addr, rate):
+        """rate is payload bytes/s downloaded from addr"""
+        rec = self._record(addr)
+        if rec is None: return
+        rec.rate = max(rec.rate, int(rate))
+
+    def failed(self, addr):
+        rec = self._record(addr)
+        if rec is None: return
+        rec.failures += 1
+        if rec.failures > MAX_FAILURES and not rec.successes:
+            del self.peers[pack_peer(addr)]
+
+    def best(self, n):
+        """up to n (IpPortPair, PeerRecord) which worked before, best first"""
+        good = [(rec.rank(), key) for key, rec in self.peers.items() if rec.successes]
+        good.sort(reverse=True)
+        return [(unpack_peer(key), self.peers[key]) for _, key in good[:n]]
+
+    def _prune(self):
+        oldest = time.time() - PEER_TTL
+        for key in [k for k, rec in self.peers.items() if rec.last_seen < oldest]:
+            del self.peers[key]
+        if len(self.peers) > self.max_peers:
+            keep = sorted(self.peers, key=lambda k: self.peers[k].rank(),
+                          reverse=True)[:self.max_peers]
+            self.peers = {k: self.peers[k] for k in keep}
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                record = dtoc_bencode.bdecode(f.read())
+            for key, last_seen, successes, failures, rate in record[b'peers']:
+                if len(key) in (6, 18):
+                    self.peers[key] = PeerRecord(last_seen, successes, failures, rate)
+        except FileNotFoundError:
+            pass
+        except (OSError, BencodeFailure, KeyError, TypeError, ValueError) as e:
+            logging.warning("Ignoring peer store %s: %s", self.path, e)
+        self._prune()
+
+    def save(self):
+        if self.path is None or not self._dirty: return
+        self._prune()
+        record = {'peers': [[key, rec.last_seen, rec.successes, rec.failures, rec.rate]
+                            for key, rec in self.peers.items()]}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(dtoc_bencode.bencode(record))
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.peers)
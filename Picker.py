@@ -0,0 +1,238 @@
+import math
+from array import array
+from bitarray import bitarray
+
+#priority tiers, highest <-...-> lowest <-> don't download
+HIGHEST = 0
+LOWEST = 3
+DONT_DOWNLOAD = 4
+
+#endgame starts when every available piece is being downloaded
+#and at most these many pieces are left in progress
+ENDGAME_THRESHOLD = 8
+
+BLOCK_SIZE = 0x4000
+
+class PiecePicker(object):
+    """Rarest first piece picker.
+
+       Wanted pieces(not downloaded, not being downloaded and not
+       DONT_DOWNLOAD) are kept in buckets[tier][availability] so that
+       a pick never has to look at whole torrent. Availability is
+       updated incrementally as peers announce or lose pieces.
+
+       downloading holds pieces handed out to BlockScheduler.
+    """
+    def __init__(self, n_pieces, endgame_threshold=ENDGAME_THRESHOLD):
+        self.availability = array('I', [0])*n_pieces
+        self.priority = bytearray([LOWEST])*n_pieces
+        self.have = bitarray(n_pieces)
+        self.have.setall(0)
+        self.downloading = set()
+        self.endgame_threshold = endgame_threshold
+        self._buckets = [dict() for _ in range(DONT_DOWNLOAD)]
+
+    def _wanted(self, index):
+        return (not self.have[index] and index not in self.downloading
+                and self.priority[index] != DONT_DOWNLOAD)
+
+    def _add(self, index):
+        avail = self.availability[index]
+        if avail == 0: return #nobody has it, nothing to pick
+        bucket = self._buckets[self.priority[index]]
+        if avail not in bucket: bucket[avail] = set()
+        bucket[avail].add(index)
+
+    def _remove(self, index):
+        avail = self.availability[index]
+        if avail == 0: return
+        bucket = self._buckets[self.priority[index]]
+        s = bucket.get(avail)
+        if s is None: return
+        s.discard(index)
+        if not s: del bucket[avail]
+
+    def _change_availability(self, index, delta):
+        wanted = self._wanted(index)
+        if wanted: self._remove(index)
+        self.availability[index] += delta
+        if wanted: self._add(index)
+
+    def inc(self, index):
+        """a peer got piece index"""
+        self._change_availability(index, 1)
+
+    def dec(self, index):
+        if self.availability[index] > 0:
+            self._change_availability(index, -1)
+
+    def peer_bitfield(self, bitfield):
+        for i in bitfield.search(1): self.inc(i)
+
+    def peer_lost(self, bitfield):
+        for i in bitfield.search(1): self.dec(i)
+
+    def pick(self, peer_has):
+        """returns rarest wanted piece of highest tier which peer has
+           and marks it as downloading. peer_has is a bitarray.
+        """
+        for bucket in self._buckets:
+            for avail in sorted(bucket):
+                for index in bucket[avail]:
+                    if peer_has[index]:
+                        self._remove(index)
+                        self.downloading.add(index)
+                        return index
+        return None
+
+    def in_endgame(self):
+        return (0 < len(self.downloading) <= self.endgame_threshold
+                and not any(self._buckets))
+
+    def abort(self, index):
+        """download of piece index failed or was given up"""
+        if index not in self.downloading: return
+        self.downloading.remove(index)
+        if self._wanted(index): self._add(index)
+
+    def we_have(self, index):
+        if self._wanted(index): self._remove(index)
+        self.downloading.discard(index)
+        self.have[index] = True
+
+    def set_priority(self, index, tier):
+        wanted = self._wanted(index)
+        if wanted: self._remove(index)
+        self.priority[index] = tier
+        if self._wanted(index): self._add(index)
+
+    def pieces_with_priority(self, tier):
+        return [i for i, p in enumerate(self.priority) if p == tier and self._wanted(i)]
+
+
+class PartialPiece(object):
+    """Assembly buffer of a piece being downloaded. blocks holds state
+       of every BLOCK_SIZE block and owners the peers a block is
+       requested from.
+    """
+    FREE, REQUESTED, RECEIVED = 0, 1, 2
+    __slots__ = ('index', 'buffer', 'blocks', 'owners', 'received')
+
+    def __init__(self, index, length):
+        self.index = index
+        self.buffer = bytearray(length)
+        self.blocks = bytearray(math.ceil(length/BLOCK_SIZE))
+        self.owners = {} #block -> set of peers
+        self.received = 0
+
+    def block_length(self, b):
+        return min(BLOCK_SIZE, len(self.buffer) - b*BLOCK_SIZE)
+
+    def add_block(self, b, data):
+        begin = b*BLOCK_SIZE
+        self.buffer[begin:begin+len(data)] = data
+        self.blocks[b] = self.RECEIVED
+        self.received += len(data)
+
+    def complete(self):
+        return self.received == len(self.buffer)
+
+    def prefix(self):
+        """number of bytes received from start of piece without a gap"""
+        for b, state in enumerate(self.blocks):
+            if state != self.RECEIVED:
+                return b*BLOCK_SIZE
+        return len(self.buffer)
+
+
+class BlockScheduler(object):
+    """Hands out blocks of pieces to peers, a piece may be downloaded
+       from many peers at once. Blocks of a piece are assembled in a
+       shared PartialPiece which is returned once all blocks arrived.
+
+       Peers are BTProtocol instances, they need peer_bitfield and
+       _cancel_block(index, begin, length).
+    """
+    def __init__(self, torrent):
+        self._torrent = torrent
+        self.picker = torrent.picker
+        self.pieces = {} #index -> PartialPiece
+
+    def _new_piece(self, index):
+        t = self._torrent
+        pp = PartialPiece(index, t.length_of_piece(index))
+        partial = t.partial.pop(index, 0)
+        if 0 < partial < len(pp.buffer):
+            #resume blocks saved by previous session
+            data = memoryview(t.read_block(index, 0, partial))
+            for b in range(len(data)//BLOCK_SIZE):
+                pp.add_block(b, data[b*BLOCK_SIZE:(b+1)*BLOCK_SIZE])
+        self.pieces[index] = pp
+        return pp
+
+    def _assign(self, pp, b, peer):
+        pp.blocks[b] = PartialPiece.REQUESTED
+        pp.owners.setdefault(b, set()).add(peer)
+        return (pp.index, b*BLOCK_SIZE, pp.block_length(b))
+
+    def _assign_free(self, pp, peer, blocks, n):
+        while len(blocks) < n:
+            b = pp.blocks.find(PartialPiece.FREE)
+            if b == -1: return
+            blocks.append(self._assign(pp, b, peer))
+
+    def request_blocks(self, peer, n):
+        """returns up to n (index, begin, length) to request from peer.
+           Pieces in progress come first, then new pieces from picker
+           and in endgame blocks already requested from other peers.
+        """
+        has = peer.peer_bitfield
+        blocks = []
+        for pp in self.pieces.values():
+            if len(blocks) == n: return blocks
+            if has[pp.index]: self._assign_free(pp, peer, blocks, n)
+        while len(blocks) < n:
+            index = self._torrent.give_me_order(has)
+            if index is None: break
+            self._assign_free(self._new_piece(index), peer, blocks, n)
+        if len(blocks) < n and self.picker.in_endgame():
+            for pp in self.pieces.values():
+                if not has[pp.index]: continue
+                for b, owners in pp.owners.items():
+                    if peer in owners: continue
+                    blocks.append(self._assign(pp, b, peer))
+                    if len(blocks) == n: return blocks
+        return blocks
+
+    def block_received(self, peer, index, begin, data):
+        """stores block and cancels it at other peers. Returns the
+           PartialPiece if it is complete now, otherwise None.
+        """
+        pp = self.pieces.get(index)
+        if pp is None or begin % BLOCK_SIZE: return None
+        b = begin // BLOCK_SIZE
+        if (b >= len(pp.blocks) or pp.blocks[b] == PartialPiece.RECEIVED
+                or len(data) != pp.block_length(b)):
+            return None
+        pp.add_block(b, data)
+        for other in pp.owners.pop(b, ()):
+            if other is not peer: other._cancel_block(index, begin, len(data))
+        if not pp.complete(): return None
+        del self.pieces[index]
+        return pp
+
+    def release(self, peer, requests):
+        """blocks (index, begin) requested from peer go back to the pool"""
+        for index, begin in requests:
+            pp = self.pieces.get(index)
+            if pp is None: continue
+            b = begin // BLOCK_SIZE
+            owners = pp.owners.get(b)
+            if owners is None: continue
+            owners.discard(peer)
+            if owners: continue
+            del pp.owners[b]
+            pp.blocks[b] = PartialPiece.FREE
+            if pp.received == 0 and not pp.owners:
+                del self.pieces[index]
+                self.picker.abort(index)
@@ -0,0 +1,90 @@
+import time
+
+#limit classes, every class has its own session wide buckets so that
+#LAN and web seed traffic doesn't eat into budget of internet peers
+PEER = 'peer'
+LAN = 'lan'
+HTTP = 'http'
+CLASSES = (PEER, LAN, HTTP)
+
+BURST = 1.0 #seconds of rate a bucket can hold
+MIN_DELAY = 0.01 #seconds
+
+
+class TokenBucket(object):
+    """Bucket refilled with rate bytes per second, rate 0 means unlimited.
+       Tokens may go negative, the debt is paid before anything else
+       passes so a whole block can be sent at once.
+    """
+    def __init__(self, rate=0, burst=BURST):
+        self.burst = burst
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = max(rate*self.burst, 1)
+        self.tokens = self.capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._last)*self.rate)
+        self._last = now
+
+    def consume(self, n, now):
+        if not self.rate: return
+        self._refill(now)
+        self.tokens -= n
+
+    def delay(self, now):
+        """seconds until bucket has tokens again, 0 if it has"""
+        if not self.rate: return 0
+        self._refill(now)
+        if self.tokens > 0: return 0
+        return -self.tokens/self.rate
+
+
+class Chain(object):
+    """Buckets a transfer goes through, e.g. peer, torrent and session.
+       Bytes are taken from all of them and the slowest one decides.
+    """
+    def __init__(self, *buckets):
+        self.buckets = [b for b in buckets if b is not None]
+
+    def consume(self, n):
+        now = None
+        for b in self.buckets:
+            if not b.rate: continue
+            if now is None: now = time.monotonic()
+            b.consume(n, now)
+
+    def delay(self):
+        """seconds to wait before next transfer, 0 if none"""
+        now = None
+        d = 0
+        for b in self.buckets:
+            if not b.rate: continue
+            if now is None: now = time.monotonic()
+            d = max(d, b.delay(now))
+        return max(d, MIN_DELAY) if d else 0
+
+
+class Limits(object):
+    """upload and download buckets of every limit class"""
+    def __init__(self):
+        self.up = {c: TokenBucket() for c in CLASSES}
+        self.down = {c: TokenBucket() for c in CLASSES}
+
+    def set_limits(self, cls=PEER, upload=None, download=None):
+        """rates in bytes per second, 0 removes the limit"""
+        if upload is not None: self.up[cls].set_rate(upload)
+        if download is not None: self.down[cls].set_rate(download)
+
+
+_default_limits = None
+
+def default_limits():
+    """Limits shared by all torrents of the process"""
+    global _default_limits
+    if _default_limits is None:
+        _default_limits = Limits()
+    return _default_limits
@@ -0,0 +1,149 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from twisted.internet import reactor, defer
+
+PIECES_PER_JOB = 64
+MAX_CHECKS = 1 #torrents hashed at once, the rest wait their turn
+
+def _map_file(path, length):
+    """returns read only mmap of path or None if it can't be mapped"""
+    if length == 0 or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def hash_pieces(paths, spans, job):
+    """Runs inside a worker.
+       paths is a list of file paths, spans is aux.SpanTable of torrent
+       and job is a list of (index, sha1). Returns indices which matched.
+    """
+    maps = {}
+    verified = []
+    try:
+        for index, digest in job:
+            h = hashlib.sha1()
+            for i, offset, l in spans.piece_segments(index):
+                if i not in maps:
+                    maps[i] = _map_file(paths[i], spans.lengths[i])
+                m = maps[i]
+                if m is None or len(m) < offset + l:
+                    break
+                h.update(memoryview(m)[offset:offset+l])
+            else:
+                if h.digest() == digest:
+                    verified.append(index)
+    finally:
+        for m in maps.values():
+            if m is not None: m.close()
+    return verified
+
+
+class RecheckPool(object):
+    """Workers shared by rechecks of all torrents. At most max_checks
+       checks run at once, others wait in order they came. Process
+       workers are spawned, not forked, as this process runs the reactor
+       and disk threads, and they are stopped whenever no check runs.
+    """
+    def __init__(self, workers=None, executor='process', max_checks=MAX_CHECKS):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.slots = defer.DeferredSemaphore(max_checks)
+        self._pool = None
+
+    def run(self, f, *args):
+        """calls f(*args), which returns a Deferred, once a slot is free"""
+        d = self.slots.run(f, *args)
+        d.addBoth(self._check_done)
+        return d
+
+    def submit(self, f, *args):
+        """runs f(*args) in a worker, returns concurrent.futures.Future"""
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._pool = ThreadPoolExecutor(self.workers)
+        return self._pool.submit(f, *args)
+
+    def _check_done(self, result):
+        if self.slots.tokens == self.slots.limit and self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        return result
+
+
+_recheck_pools = {}
+
+def recheck_pool(workers=None, executor='process'):
+    """RecheckPool shared by all torrents of the process"""
+    key = (workers, executor)
+    if key not in _recheck_pools:
+        _recheck_pools[key] = RecheckPool(workers, executor)
+    return _recheck_pools[key]
+
+
+class RecheckEngine(object):
+    """Hashes pieces of a torrent on a RecheckPool.
+
+       check() returns a Deferred which fires with a set of verified
+       piece indices. progress(done, total) is called in reactor thread
+       after every finished job.
+    """
+    def __init__(self, torrent, pool=None, progress=None):
+        self._torrent = torrent
+        self._pool = pool or recheck_pool()
+        self._progress = progress
+        self._deferred = None
+
+    def check(self, indices=None):
+        return self._pool.run(self._check, indices)
+
+    def _check(self, indices):
+        t = self._torrent
+        if indices is None:
+            indices = range(len(t.pieces))
+        indices = sorted(indices)
+        paths = [f.path for f in t.files]
+        jobs = [[(i, t.pieces[i]) for i in indices[n:n+PIECES_PER_JOB]]
+                for n in range(0, len(indices), PIECES_PER_JOB)]
+        d = defer.Deferred()
+        self._deferred = d
+        self._verified = set()
+        self._done = 0
+        self._total = len(indices)
+        self._pending = len(jobs)
+        self._futures = []
+        if not jobs:
+            d.callback(self._verified)
+            return d
+        for job in jobs:
+            future = self._pool.submit(hash_pieces, paths, t.spans, job)
+            self._futures.append(future)
+            future.add_done_callback(
+                lambda f, n=len(job): reactor.callFromThread(self._job_done, f, n))
+        return d
+
+    def _job_done(self, future, n):
+        if self._deferred is None: return
+        self._pending -= 1
+        try:
+            self._verified.update(future.result())
+        except Exception as e:
+            logging.error("Recheck job failed %s", e)
+            for f in self._futures: f.cancel()
+            d, self._deferred = self._deferred, None
+            d.errback(e)
+            return
+        self._done += n
+        if self._progress is not None:
+            self._progress(self._done, self._total)
+        if self._pending == 0:
+            d, self._deferred = self._deferred, None
+            d.callback(self._verified)
@@ -0,0 +1,57 @@
+import os
+import logging
+
+import dtoc_bencode
+from dtoc_exceptions import BencodeFailure
+
+DEFAULT_RESUME_DIR = os.path.join(os.path.expanduser('~'), '.dtoc', 'resume')
+RESUME_INTERVAL = 300 #seconds
+
+def resume_path(resume_dir, info_hash_str):
+    return os.path.join(resume_dir, info_hash_str + '.resume')
+
+def file_stats(files):
+    """returns [size, mtime_ns] of every file, [-1, 0] for missing ones"""
+    stats = []
+    for f in files:
+        try:
+            st = os.stat(f.path)
+        except OSError:
+            stats.append([-1, 0])
+        else:
+            stats.append([st.st_size, st.st_mtime_ns])
+    return stats
+
+def changed_files(record, files):
+    """returns indices of files whose size or mtime differ from record"""
+    old = record[b'files']
+    return [i for i, st in enumerate(file_stats(files)) if list(old[i]) != st]
+
+def load(path, info_hash, n_pieces, n_files):
+    """returns decoded resume record or None if it is missing or stale"""
+    try:
+        with open(path, 'rb') as f:
+            record = dtoc_bencode.bdecode(f.read())
+    except (OSError, BencodeFailure):
+        return None
+    if (record.get(b'info_hash') != info_hash or
+            record.get(b'pieces') != n_pieces or
+            len(record.get(b'files', [])) != n_files):
+        logging.warning("Ignoring stale resume file %s", path)
+        return None
+    return record
+
+def save(path, info_hash, bitfield, files, partial):
+    """partial is a dict {piece index: bytes already on disk}"""
+    record = {
+        'info_hash': info_hash,
+        'pieces': len(bitfield),
+        'bitfield': bitfield.tobytes(),
+        'files': file_stats(files),
+        'partial': sorted([i, l] for i, l in partial.items()),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(dtoc_bencode.bencode(record))
+    os.replace(tmp, path)
@@ -0,0 +1,188 @@
+import logging
+from collections import OrderedDict
+from twisted.internet import reactor, defer
+
+import Torrent
+import Metainfo
+import PeerProtocol
+import Tracker
+import Storage
+import RateLimit
+import Connections
+from dtoc_exceptions import DTOCFailure
+
+DEFAULT_PORT = 6891
+MAX_ACTIVE = 8 #torrents downloading at once, seeding ones don't count
+SCHEDULE_INTERVAL = 5 #seconds
+SCRAPE_INTERVAL = 1800 #seconds
+SCRAPE_DELAY = 2 #seconds torrents added meanwhile are scraped together
+
+
+class Session(object):
+    """Torrents of one process. They share a single listening port,
+       disk queue, rate limits and connection budget.
+
+       Incoming connections are routed to torrents by info_hash of the
+       handshake. At most max_active torrents download at once, the
+       rest wait in order they were added, those which scrape shows have
+       no seeders go last. Seeding torrents always run.
+    """
+    def __init__(self, port=DEFAULT_PORT, max_active=MAX_ACTIVE, verbose=1,
+                 disk_queue=None, limits=None, budget=None,
+                 scrape_interval=SCRAPE_INTERVAL, tracker_client=None, **torrent_args):
+        self.port = port
+        self.max_active = max_active
+        self.verbose = verbose
+        self.torrent_args = torrent_args #defaults for every Torrent
+        self.torrents = OrderedDict() #info_hash -> Torrent, in order added
+        self.paused = set() #info_hashes paused by user
+        self.disk = disk_queue or Storage.default_disk_queue()
+        self.limits = limits or RateLimit.default_limits()
+        self.budget = budget or Connections.default_budget()
+        self.scrape_interval = scrape_interval
+        self.tracker_client = tracker_client
+        self._listeners = []
+        self._timer = None
+        self._scrape_timer = None
+        self._new_scrapes = set() #info_hashes added since last scrape
+        self._new_scrape_timer = None
+
+    def start(self):
+        self._listeners = [
+            reactor.listenTCP(self.port, PeerProtocol.BTSessionFactory(self)),
+        ]
+        self._timer = reactor.callLater(0, self._tick)
+        if self.scrape_interval:
+            self._scrape_timer = reactor.callLater(0, self._periodic_scrape)
+
+    def stop(self):
+        for timer in (self._timer, self._scrape_timer, self._new_scrape_timer):
+            if timer is not None and timer.active(): timer.cancel()
+        self._timer = self._scrape_timer = self._new_scrape_timer = None
+        for t in self.torrents.values():
+            t.close()
+        for l in self._listeners:
+            l.stopListening()
+        self._listeners = []
+
+    def add_torrent(self, path, save_path="./", paused=False, **kwargs):
+        """returns new Torrent, it is started when a slot is free"""
+        args = dict(self.torrent_args)
+        args.update(kwargs)
+        #duplicate is rejected before anything is loaded or rechecked
+        meta = path if isinstance(path, Metainfo.Metainfo) else Metainfo.Metainfo.from_file(path)
+        if meta.info_hash in self.torrents:
+            raise DTOCFailure("Torrent %s already added" % meta.info_hash_str)
+        t = Torrent.Torrent(meta, save_path, port=self.port, verbose=self.verbose,
+                            disk_queue=self.disk, limits=self.limits,
+                            conn_budget=self.budget, **args)
+        self.torrents[t.info_hash] = t
+        if paused: self.paused.add(t.info_hash)
+        if self._listeners and self.scrape_interval:
+            #counts of queued torrents come only from scrapes
+            self._new_scrapes.add(t.info_hash)
+            if self._new_scrape_timer is None:
+                self._new_scrape_timer = reactor.callLater(SCRAPE_DELAY, self._scrape_new)
+        self._schedule()
+        return t
+
+    def remove_torrent(self, info_hash):
+        t = self.torrents.pop(info_hash)
+        self.paused.discard(info_hash)
+        t.close()
+        self._schedule()
+        return t
+
+    def pause(self, info_hash):
+        if info_hash not in self.torrents: raise KeyError(info_hash)
+        self.paused.add(info_hash)
+        self._schedule()
+
+    def resume(self, info_hash):
+        if info_hash not in self.torrents: raise KeyError(info_hash)
+        self.paused.discard(info_hash)
+        self._schedule()
+
+    def state(self, info_hash):
+        t = self.torrents[info_hash]
+        if info_hash in self.paused: return 'paused'
+        if t.status == 'checking': return 'checking'
+        if not t.running: return 'queued'
+        return 'seeding' if t.finished() else 'downloading'
+
+    def route(self, info_hash):
+        """torrent an incoming handshake is for, None if it can't be served"""
+        t = self.torrents.get(info_hash)
+        if t is None or not t.running or not t.conn_manager.accept_incoming():
+            return None
+        return t
+
+    def scrape(self, info_hashes=None):
+        """Scrapes every udp tracker of our torrents, or of info_hashes
+           only, all torrents of a tracker in as few packets as possible.
+           Returns Deferred which fires when all trackers answered or failed.
+        """
+        #(host, port) -> {info_hash: urls}, counts are kept by url as
+        #announces keep them
+        by_tracker = {}
+        for info_hash, t in self.torrents.items():
+            if info_hashes is not None and info_hash not in info_hashes: continue
+            for url in t.tracker_urls():
+                try:
+                    tracker = Tracker.parse_udp_url(url)
+                except ValueError:
+                    continue
+                by_tracker.setdefault(tracker, {}).setdefault(info_hash, []).append(url)
+        client = self.tracker_client or Tracker.default_tracker_client()
+        ds = []
+        for (host, port), urls in by_tracker.items():
+            d = reactor.resolve(host)
+            d.addCallback(lambda ip, port=port, hashes=list(urls):
+                          client.scrape((ip, port), hashes))
+            d.addCallbacks(self._scraped, self._scrape_failed,
+                           callbackArgs=(urls,), errbackArgs=('%s:%d' % (host, port),))
+            ds.append(d)
+        return defer.DeferredList(ds)
+
+    def _scraped(self, counts, urls):
+        for info_hash, (seeders, completed, leechers) in counts.items():
+            t = self.torrents.get(info_hash)
+            if t is None: continue
+            for url in urls.get(info_hash, ()):
+                t.scraped(url, seeders, completed, leechers)
+        self._schedule()
+
+    def _scrape_failed(self, failure, tracker):
+        logging.warning("Scrape of %s failed: %s", tracker, failure.getErrorMessage())
+
+    def _scrape_new(self):
+        self._new_scrape_timer = None
+        hashes, self._new_scrapes = self._new_scrapes, set()
+        self.scrape(hashes)
+
+    def _periodic_scrape(self):
+        self._scrape_timer = reactor.callLater(self.scrape_interval, self._periodic_scrape)
+        self.scrape()
+
+    def _tick(self):
+        self._timer = reactor.callLater(SCHEDULE_INTERVAL, self._tick)
+        self._schedule()
+
+    def _schedule(self):
+        if not self._listeners: return #not started yet
+        downloading = 0
+        #stable, so order of adding holds within both groups
+        order = sorted(self.torrents.items(), key=lambda item: item[1].seeders == 0)
+        for info_hash, t in order:
+            if info_hash in self.paused:
+                t.stop()
+                continue
+            seeding = t.status != 'checking' and t.finished()
+            if seeding or downloading < self.max_active:
+                if not seeding: downloading += 1
+                try:
+                    t.start()
+                except Exception:
+                    logging.exception("Could not start %s", t.name)
+            elif t.running:
+                t.stop()
@@ -0,0 +1,366 @@
+import abc
+import mmap
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+DISK_THREADS = 4
+MAX_PENDING_JOBS = 16
+PIECE_CACHE_SIZE = 64*1024*1024 #bytes
+MAX_OPEN_FILES = 256
+
+
+class Storage(abc.ABC):
+    """Interface for piece I/O. Pieces are addressed by (index, begin)
+       and are mapped to files through aux.SpanTable of torrent.
+    """
+    def __init__(self, files, spans):
+        self.files = files
+        self.spans = spans
+
+    @abc.abstractmethod
+    def read(self, index, begin, length):
+        """returns a bytes like object, shorter than length if data is missing"""
+
+    @abc.abstractmethod
+    def write(self, index, begin, data):
+        """writes data at begin of piece index, returns number of bytes written"""
+
+    def touch(self, file_index):
+        """creates file if it is missing, used for empty files which are
+           never written to
+        """
+        path = self.files[file_index].path
+        if not os.path.exists(path):
+            _make_parent(path)
+            open(path, 'ab').close()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _make_parent(path):
+    parent = os.path.dirname(path)
+    if parent: os.makedirs(parent, exist_ok=True)
+
+
+def _open_file(path, create):
+    try:
+        return open(path, 'rb+')
+    except FileNotFoundError:
+        if not create: return None
+        _make_parent(path)
+        return open(path, 'wb+')
+
+def _close(obj):
+    try:
+        obj.close()
+    except BufferError:
+        #some memoryview of mmap is still alive, gc will unmap it
+        logging.debug("mmap still exported, not closing")
+
+
+class FilePool(object):
+    """LRU of open files(or maps of them) shared by storages of all
+       torrents. At most max_open idle ones are kept open, one in use is
+       never closed so the cap may be exceeded while many disk jobs run
+       at once. opener(path, create) returns the object to keep, None if
+       path is missing and create is False.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.opens = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict() #(opener, path) -> [object, users]
+
+    @contextmanager
+    def open(self, path, create=False, opener=_open_file):
+        """yields file opened for reading and writing, None if it is
+           missing and create is False
+        """
+        key = (opener, path)
+        f = self._acquire(key, create)
+        try:
+            yield f
+        finally:
+            if f is not None: self._release(key)
+
+    def _acquire(self, key, create):
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is not None:
+                self._files.move_to_end(key)
+                entry[1] += 1
+                return entry[0]
+            f = key[0](key[1], create)
+            if f is None: return None
+            self.opens += 1
+            self._files[key] = [f, 1]
+            self._evict()
+            return f
+
+    def _release(self, key):
+        with self._lock:
+            self._files[key][1] -= 1
+            self._evict()
+
+    def _evict(self):
+        if len(self._files) <= self.max_open: return
+        for key, (f, users) in list(self._files.items()):
+            if users == 0:
+                del self._files[key]
+                _close(f)
+                if len(self._files) <= self.max_open: break
+
+    def flush(self, paths, opener=_open_file):
+        with self._lock:
+            for path in paths:
+                entry = self._files.get((opener, path))
+                if entry is not None: entry[0].flush()
+
+    def close(self, paths, opener=_open_file):
+        """closes idle entries of paths, ones in use are left to LRU"""
+        with self._lock:
+            for path in paths:
+                entry = self._files.get((opener, path))
+                if entry is None or entry[1] > 0: continue
+                del self._files[(opener, path)]
+                _close(entry[0])
+
+    def __len__(self):
+        return len(self._files)
+
+
+_default_file_pool = None
+
+def default_file_pool():
+    """FilePool shared by all torrents of the process"""
+    global _default_file_pool
+    if _default_file_pool is None:
+        _default_file_pool = FilePool()
+    return _default_file_pool
+
+
+class FileStorage(Storage):
+    """Buffered python file objects from a FilePool, opened on first use.
+       Files are created on first write, reads of missing files come back
+       short. Every read returns a new buffer. seek+read/write pairs are
+       serialised as disk jobs run in threads.
+    """
+    def __init__(self, files, spans, pool=None):
+        super().__init__(files, spans)
+        self.pool = default_file_pool() if pool is None else pool
+        self._lock = threading.Lock()
+
+    def read(self, index, begin, length):
+        segs = self.spans.piece_segments(index, begin, length)
+        with self._lock:
+            if len(segs) == 1:
+                i, offset, l = segs[0]
+                with self.pool.open(self.files[i].path) as f:
+                    if f is None: return b''
+                    f.seek(offset)
+                    return f.read(l)
+            block = bytearray()
+            for i, offset, l in segs:
+                with self.pool.open(self.files[i].path) as f:
+                    if f is None: break
+                    f.seek(offset)
+                    data = f.read(l)
+                block.extend(data)
+                if len(data) < l: break
+            return block
+
+    def write(self, index, begin, data):
+        data = memoryview(data)
+        wrote = 0
+        with self._lock:
+            for i, offset, l in self.spans.piece_segments(index, begin, len(data)):
+                with self.pool.open(self.files[i].path, create=True) as f:
+                    f.seek(offset)
+                    wrote += f.write(data[wrote:wrote+l])
+        return wrote
+
+    def flush(self):
+        with self._lock:
+            self.pool.flush(f.path for f in self.files)
+
+    def close(self):
+        with self._lock:
+            self.pool.close(f.path for f in self.files)
+
+
+class MmapStorage(Storage):
+    """Files are memory mapped on first use. Maps come from a FilePool, so
+       at most max_open idle ones stay mapped. Reads within one file
+       return memoryview into the map and writes land in place. Like
+       FileStorage files are created only when written to.
+    """
+    def __init__(self, files, spans, pool=None):
+        super().__init__(files, spans)
+        self.pool = default_file_pool() if pool is None else pool
+        self._lengths = {f.path: f.length for f in files}
+
+    def _open_map(self, path, create):
+        if not os.path.exists(path):
+            if not create: return None
+            _make_parent(path)
+        length = self._lengths[path]
+        with open(path, 'rb+' if os.path.exists(path) else 'wb+') as fo:
+            if os.fstat(fo.fileno()).st_size < length:
+                fo.truncate(length)
+            return mmap.mmap(fo.fileno(), length)
+
+    def _map(self, i, create=False):
+        return self.pool.open(self.files[i].path, create, self._open_map)
+
+    def read(self, index, begin, length):
+        segs = self.spans.piece_segments(index, begin, length)
+        if len(segs) == 1:
+            i, offset, l = segs[0]
+            with self._map(i) as m:
+                if m is None: return b''
+                #an evicted map stays alive while this view does
+                return memoryview(m)[offset:offset+l]
+        block = bytearray()
+        for i, offset, l in segs:
+            with self._map(i) as m:
+                if m is None: break
+                block += memoryview(m)[offset:offset+l]
+        return block
+
+    def write(self, index, begin, data):
+        data = memoryview(data)
+        wrote = 0
+        for i, offset, l in self.spans.piece_segments(index, begin, len(data)):
+            with self._map(i, create=True) as m:
+                m[offset:offset+l] = data[wrote:wrote+l]
+            wrote += l
+        return wrote
+
+    def flush(self):
+        self.pool.flush((f.path for f in self.files), self._open_map)
+
+    def close(self):
+        self.pool.close((f.path for f in self.files), self._open_map)
+
+
+class DiskQueue(object):
+    """Runs disk jobs(hashing, writes) on a bounded thread pool.
+
+       Registered producers(peer transports) are paused while more than
+       max_pending jobs are waiting and resumed once half of them are done.
+    """
+    def __init__(self, threads=DISK_THREADS, max_pending=MAX_PENDING_JOBS):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.paused = False
+        self._producers = set()
+        self._pool = ThreadPool(1, threads, name='dtoc-disk')
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def submit(self, f, *args, **kwargs):
+        """returns Deferred which fires with result of f in reactor thread"""
+        self.pending += 1
+        if self.pending >= self.max_pending and not self.paused:
+            self.paused = True
+            for p in self._producers: p.pauseProducing()
+        d = threads.deferToThreadPool(reactor, self._pool, f, *args, **kwargs)
+        d.addBoth(self._job_done)
+        return d
+
+    def _job_done(self, result):
+        self.pending -= 1
+        if self.paused and self.pending <= self.max_pending//2:
+            self.paused = False
+            for p in self._producers: p.resumeProducing()
+        return result
+
+    def register(self, producer):
+        self._producers.add(producer)
+        if self.paused: producer.pauseProducing()
+
+    def unregister(self, producer):
+        self._producers.discard(producer)
+
+
+class PieceCache(object):
+    """LRU cache of verified pieces shared by all connections of a
+       torrent. Total size of cached pieces stays below budget bytes.
+       Consecutive lookups of one piece, as when its blocks are uploaded,
+       count as a single hit or miss.
+    """
+    def __init__(self, budget=PIECE_CACHE_SIZE):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pieces = OrderedDict()
+        self._missed = set() #pieces missed once since they were cached
+        self._last = None #piece of last lookup
+
+    def get(self, index):
+        piece = self._pieces.get(index)
+        if piece is not None: self._pieces.move_to_end(index)
+        if index != self._last:
+            self._last = index
+            if piece is None: self.misses += 1
+            else: self.hits += 1
+        return piece
+
+    def missed(self, index):
+        """records a miss of index, True if it was missed before and so
+           is worth caching
+        """
+        if index in self._missed: return True
+        self._missed.add(index)
+        return False
+
+    def put(self, index, piece):
+        self._missed.discard(index)
+        if len(piece) > self.budget: return
+        self.discard(index)
+        self._pieces[index] = piece
+        self.size += len(piece)
+        while self.size > self.budget:
+            _, old = self._pieces.popitem(last=False)
+            self.size -= len(old)
+
+    def discard(self, index):
+        piece = self._pieces.pop(index, None)
+        if piece is not None:
+            self.size -= len(piece)
+
+    def clear(self):
+        self._pieces.clear()
+        self._missed.clear()
+        self._last = None
+        self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'pieces': len(self._pieces), 'bytes': self.size}
+
+
+_default_disk_queue = None
+
+def default_disk_queue():
+    """DiskQueue shared by all torrents of the process"""
+    global _default_disk_queue
+    if _default_disk_queue is None:
+        _default_disk_queue = DiskQueue()
+    return _default_disk_queue
+
+
+BACKENDS = {
+    'file': FileStorage,
+    'mmap': MmapStorage,
+}
@@ -1,6 +1,5 @@
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 import hashlib
-import os
 import random
 from bitarray import bitarray
 import string
@@ -9,138 +8,265 @@ import logging
 import sys
 import time
 
-import dtoc_bencode
-import dtoc_exceptions
 import aux
-import Tracker
+import Metainfo
+import Announcer
 import PeerProtocol
 import LNDP
+import Recheck
+import Resume
+import PeerStore
+import Storage
+import Picker
+import Choker
+import RateLimit
+import Connections
 
-MAX_CONNECTONS = 1
+HAVE_MODES = ('all', 'suppress', 'batch')
+HAVE_BATCH_INTERVAL = 0.5 #seconds
 BAR_LENGTH = 30
 
 class Torrent(object):
-    def __init__(self, path, save_path="./", name=None, port = 6891, verbose=1):
-        try:
-            f = open(path, 'rb')
-            file_data_binary = f.read()
-            bdecoded = dtoc_bencode.bdecode(file_data_binary)
-        except Exception:
-            raise
+    def __init__(self, path, save_path="./", name=None, port = 6891, verbose=1,
+                 recheck_workers=None, recheck_executor='process', resume_dir=None,
+                 storage='file', disk_queue=None, file_pool=None,
+                 piece_cache_size=Storage.PIECE_CACHE_SIZE,
+                 endgame_threshold=Picker.ENDGAME_THRESHOLD, have_mode='all',
+                 upload_slots=Choker.UPLOAD_SLOTS, choke_interval=Choker.CHOKE_INTERVAL,
+                 limits=None, upload_limit=0, download_limit=0,
+                 peer_upload_limit=0, peer_download_limit=0,
+                 max_peers=Connections.MAX_PEERS, conn_budget=None, tracker_client=None):
+        #path of .torrent file or Metainfo.Metainfo
+        if isinstance(path, Metainfo.Metainfo):
+            meta = path
         else:
-            f.close()
+            meta = Metainfo.Metainfo.from_file(path)
+        self.metainfo = meta
 
-        self.connections = set() #just outgoing
+        self.connections = set() #addresses of established outgoing connections
         self.current_protocols = set() #all instances of PeerProtocol
-        self._client_factory = None
+        self.info_hash_str = meta.info_hash_str
+        self.peer_store = PeerStore.PeerStore(PeerStore.peer_path(
+            resume_dir or Resume.DEFAULT_RESUME_DIR, self.info_hash_str))
+        self.conn_manager = Connections.ConnectionManager(self, max_peers, conn_budget,
+                                                          self.peer_store)
+        self.peers = self.conn_manager.peers #IpPortPair -> Connections.PeerInfo
 
-        self.peers = set()
-        self.trackers = []
+        self.announcer = Announcer.Announcer(self, meta.announce_tiers, tracker_client)
+        self.scrapes = {} #tracker url -> (seeders, completed, leechers)
+        self.seeders = self.leechers = -1 #best scraped counts, negative if unknown
+        self.running = False
+        self._start_wanted = False #start once check is done
+        self.lndp = None
         self.verbose = verbose
         self.status = 'idle'
         self.port = port
-        self.announce = bdecoded[b'announce'].decode('utf-8')
-        self.announce_list = [l[0].decode('utf-8')
-                              for l in bdecoded.get(b'announce-list',[])]
+        self.announce = meta.announce
 
         self.save_path = save_path
-        if not os.path.exists(save_path): os.makedirs(save_path)
 
-        info = bdecoded[b'info']
-        info_hash_temp = hashlib.sha1(dtoc_bencode.bencode(info))
-        self.info_hash = info_hash_temp.digest()
-        self.info_hash_str = info_hash_temp.hexdigest()
+        self.info_hash = meta.info_hash
         if name is None:
             self.name = self.info_hash_str[:4] + '...' + self.info_hash_str[-4:]
         else:
             self.name = name
         self.peer_id = "-DT0001-" + ''.join(random.choice(string.digits) for i in range(12))
         self.peer_id = self.peer_id.encode('ascii')
-        self.piece_length = info[b'piece length']
+        self.piece_length = meta.piece_length
         self.key = int(random.random()*2**31)
 
-        files = info.get(b'files', None)
-        self.size = 0
-        if files:
-            self.file_mode = 'multi'
-            self.base_dir = info[b'name'].decode('utf-8')
-            temp = os.path.join(self.save_path, self.base_dir)
-            if not os.path.exists(temp):
-                os.makedirs(temp)
-            self.files = []
-            temp_offset = 0
-            for file_ in files:
-                self.size += file_.get(b'length')
-                lst = [s.decode('utf-8') for s in file_[b'path']]
-                temp = os.path.join(self.save_path, self.base_dir, *lst)
-                self.files.append(aux.FileMetaData(temp,
-                                                   int(file_[b'length']),
-                                                   file_.get(b'md5sum', None),
-                                                   temp_offset))
-                temp_offset += int(file_[b'length'])
-        else:
-            self.file_mode = 'single'
-            self.size += info.get(b'length')
-            temp = os.path.join(self.save_path, info[b'name'].decode('utf-8'))
-            self.files = [aux.FileMetaData(temp,
-                                         info[b'length'],
-                                         info.get(b'md5sum', None), 0)]
-        self._open_files = []
-        for f in self.files:
-            if os.path.exists(f.path):
-                self._open_files.append(open(f.path, 'rb+'))
-            else:
-                self._open_files.append(open(f.path, 'wb+'))
-
-        temp = info[b'pieces']
-        self.pieces = [temp[i*20:i*20+20] for i in range(len(temp)//20)]
+        self.file_mode = meta.file_mode
+        self.size = meta.size
+        self.files = meta.file_metadata(self.save_path)
+        if self.file_mode == 'multi':
+            self.base_dir = meta.name
+        self.spans = aux.SpanTable(self.files, self.piece_length)
+        #files and directories are created on first write
+        self.storage = Storage.BACKENDS[storage](self.files, self.spans, file_pool)
+        self.disk = disk_queue or Storage.default_disk_queue()
+        self.piece_cache = Storage.PieceCache(piece_cache_size)
+        #rates in bytes per second, 0 is unlimited
+        self.limits = limits or RateLimit.default_limits()
+        self.up_bucket = RateLimit.TokenBucket(upload_limit)
+        self.down_bucket = RateLimit.TokenBucket(download_limit)
+        self.peer_upload_limit = peer_upload_limit
+        self.peer_download_limit = peer_download_limit
+
+        self.pieces = meta.pieces
         self.bitfield = bitarray(len(self.pieces))
         self.bitfield.setall(0)
-        #priority queue highest <-...-> lowest <-> don't download
-        self.queue = [set(), set(), set(), None, set()]
-        self.queue[3] = set(i for i in range(len(self.pieces)))
-        self.force_recheck()
+        self.picker = Picker.PiecePicker(len(self.pieces), endgame_threshold)
+        self.scheduler = Picker.BlockScheduler(self)
+        self.choker = Choker.Choker(self, upload_slots, choke_interval)
+        self.downloaded = 0
+        self.downloaded_session = self.uploaded_session = 0
+        self.file_priority = bytearray([Picker.LOWEST])*len(self.files)
+        self.partial = {} #piece index -> unverified bytes on disk
+        #'all' sends HAVE to every peer, 'suppress' skips peers which
+        #have the piece, 'batch' also sends them together periodically
+        self.have_mode = have_mode
+        self._pending_haves = []
+        self._have_timer = None
+        self._recheck = Recheck.RecheckEngine(
+            self, Recheck.recheck_pool(recheck_workers, recheck_executor),
+            self._recheck_progress)
+        self._resume_path = Resume.resume_path(resume_dir or Resume.DEFAULT_RESUME_DIR,
+                                               self.info_hash_str)
+        self._resume_timer = None
+        record = Resume.load(self._resume_path, self.info_hash,
+                             len(self.pieces), len(self.files))
+        if record is None:
+            self._checked = self.force_recheck()
+        else:
+            self._checked = self._fast_resume(record)
 
     def start(self):
-        if self.status == 'started': return
+        if self.running: return
+        if self.status == 'checking':
+            if not self._start_wanted:
+                self._checked.addCallback(self._start_checked)
+            self._start_wanted = True
+            return
         if self.verbose > 15: print(self.name, "Staring...")
+        self.running = True
         self.started_at = time.time()
         self.downloaded_session = 0
         self.uploaded_session = 0
-        self._client_factory = PeerProtocol.BTClientFactory(self)
-        url = self.announce
-        if not url.startswith('udp://'):
-            raise(DTOCFailure("Non udp trackers not supported yet"))
-        self.trackers.append(Tracker.UDPTracker(self, url, self.verbose))
-        for url in self.announce_list:
-            if url.startswith('udp://'):
-                self.trackers.append(Tracker.UDPTracker(self, url, self.verbose))
+        for i, f in enumerate(self.files):
+            if f.length == 0 and self.file_priority[i] != Picker.DONT_DOWNLOAD:
+                self.storage.touch(i)
+        self.conn_manager.start()
+        for addr, rec in self.peer_store.best(self.conn_manager.max_peers):
+            self.conn_manager.add_known_peer(addr, rec.rate)
+        self.connect_peers()
+        self._resume_timer = reactor.callLater(Resume.RESUME_INTERVAL, self._periodic_save)
+        self.choker.start()
+        self.announcer.start()
         self.lndp = LNDP.LNDPProtocol(self)
 
+    def tracker_urls(self):
+        return self.announcer.urls()
+
+    def scraped(self, tracker, seeders, completed, leechers):
+        self.scrapes[tracker] = (seeders, completed, leechers)
+        self.seeders = max(s[0] for s in self.scrapes.values())
+        self.leechers = max(s[2] for s in self.scrapes.values())
+
+    def _start_checked(self, result):
+        if self._start_wanted:
+            self._start_wanted = False
+            self.start()
+        return result
+
     def peer_list_update(self, ips):
         if (self.verbose > 15): print("Peer list updated")
-        self.peers.update(ips)
+        self.peer_store.seen(ips)
+        self.conn_manager.add_peers(ips)
         self.state = 'started'
         self.connect_peers()
 
-    def connect_peer(self, peer):
-        reactor.connectTCP(peer.ip, peer.port, self._client_factory)
-
     def connect_peers(self):
-        if self.progress() == 1.0: return
-        if len(self.connections) > MAX_CONNECTONS: return
-        lst = list(self.peers)
-        random.shuffle(lst)
-        for p in lst:
-            if p in self.connections: continue
-            self.connect_peer(p)
-            if len(self.connections) > MAX_CONNECTONS: break
+        self.conn_manager.connect_peers()
 
     def stop(self):
-        logging.shutdown()
-        print(self.name, "\nStopping...")
-        for t in self.trackers: t.stop()
-        for f in self._open_files: f.close()
+        """stops announcing and drops all connections, start() resumes"""
+        self._start_wanted = False
+        if not self.running: return
+        self.running = False
+        if self.verbose > 0: print(self.name, "\nStopping...")
+        self.announcer.stop()
+        if self.lndp is not None: self.lndp.lndp_finder.stop()
+        self.choker.stop()
+        self.conn_manager.stop()
+        for p in list(self.current_protocols):
+            p.transport.loseConnection()
+        if self._resume_timer is not None and self._resume_timer.active():
+            self._resume_timer.cancel()
+        if self._have_timer is not None and self._have_timer.active():
+            self._have_timer.cancel()
+        self._resume_timer = self._have_timer = None
+        self.save_resume()
+
+    def close(self):
+        """stops torrent and releases its storage"""
+        if self.running:
+            self.stop()
+        else:
+            self._start_wanted = False
+            self.save_resume()
+        self.piece_cache.clear()
+        self.storage.close()
+
+    def broadcast_have(self, index):
+        """announces a verified piece to connected peers as per have_mode"""
+        if self.have_mode != 'batch':
+            self._send_haves([index])
+            return
+        self._pending_haves.append(index)
+        if self._have_timer is None:
+            self._have_timer = reactor.callLater(HAVE_BATCH_INTERVAL, self._flush_haves)
+
+    def _flush_haves(self):
+        self._have_timer = None
+        haves, self._pending_haves = self._pending_haves, []
+        self._send_haves(haves)
+
+    def _send_haves(self, indices):
+        suppress = self.have_mode != 'all'
+        for protocol in self.current_protocols:
+            if protocol.state != PeerProtocol.BTProtocolStates.connected: continue
+            for index in indices:
+                if suppress and protocol.peer_bitfield[index]: continue
+                protocol._send_have(index)
+
+    def _fast_resume(self, record):
+        """Trusts resume record and rechecks only pieces of changed files."""
+        changed = Resume.changed_files(record, self.files)
+        suspect = set()
+        for i in changed:
+            if self.files[i].length == 0: continue
+            first, _, last, _ = self.file_to_range(i)
+            suspect.update(range(first, last+1))
+        trusted = bitarray(endian='big')
+        trusted.frombytes(record[b'bitfield'])
+        del trusted[len(self.pieces):]
+        for i in trusted.search(1):
+            if i in suspect: continue
+            self.bitfield[i] = True
+            self.downloaded += self.length_of_piece(i)
+            self.picker.we_have(i)
+        for i, l in record.get(b'partial', []):
+            if i not in suspect and not self.bitfield[i]:
+                self.partial[i] = l
+        if self.verbose >= 1:
+            print(self.name, "Resumed. %d changed files" % len(changed))
+        if suspect:
+            return self.force_recheck(suspect)
+        self.status = 'seeding' if self.downloaded == self.size else 'idle'
+        return defer.succeed(None)
+
+    def save_resume(self):
+        """Writes resume record. Unverified partial pieces are flushed to
+           disk first so that they can be picked up after restart.
+        """
+        if self.status == 'checking': return
+        partial = dict(self.partial)
+        for index, pp in self.scheduler.pieces.items():
+            prefix = pp.prefix()
+            if prefix > partial.get(index, 0):
+                self.write_block(index, 0, memoryview(pp.buffer)[:prefix])
+                partial[index] = prefix
+        self.storage.flush()
+        try:
+            Resume.save(self._resume_path, self.info_hash, self.bitfield,
+                        self.files, partial)
+            self.peer_store.save()
+        except OSError as e:
+            logging.error("Could not save resume file: %s", e)
+
+    def _periodic_save(self):
+        self.save_resume()
+        self._resume_timer = reactor.callLater(Resume.RESUME_INTERVAL, self._periodic_save)
 
     def index_to_file(self, index):
         """This method returns a file its index in files list
@@ -148,62 +274,91 @@ class Torrent(object):
            in file.
            Note: some part of piece may belong to next file.
         """
-        index *= self.piece_length
-        for i,file_ in enumerate(self.files):
-            if index < file_.length:
-                return (i, file_, index)
-            else:
-                index -= file_.length
-        raise ValueError("Too high index")
+        try:
+            i = self.spans.file_at(index*self.piece_length)
+        except ValueError:
+            raise ValueError("Too high index")
+        return (i, self.files[i], self.spans.offset_of_index_into_file(i, index))
 
     def file_to_range(self, file_index):
         """returns (start_piece, start_offset, end_piece, end_offset)"""
-        pass
+        return self.spans.file_to_range(file_index)
 
     def offset_of_index_into_file(self, file_index, index):
-        pass
+        return self.spans.offset_of_index_into_file(file_index, index)
 
-    def force_recheck(self):
+    def force_recheck(self, indices=None):
+        """Rechecks pieces(all by default) on worker pool.
+           Returns a Deferred which fires once bitfield is updated.
+        """
         if self.verbose >= 1: print(self.name, "Force rechecking.")
-        self.downloaded = 0
-        for i in range(len(self.pieces)):
-            if self.read_piece(i) is not None and not self.bitfield[i]:
+        self.status = 'checking'
+        d = self._recheck.check(indices)
+        d.addCallback(self._recheck_done)
+        d.addErrback(self._recheck_failed)
+        return d
+
+    def _recheck_progress(self, done, total):
+        if self.verbose < 1: return
+        s = '%s Rechecking %6.2f%%' % (self.name, done*100/total)
+        print('\b'*len(s), end='')
+        print(s, end='')
+        if done == total: print()
+        sys.stdout.flush()
+
+    def _recheck_done(self, verified):
+        for i in verified:
+            if not self.bitfield[i]:
+                self.bitfield[i] = True
                 self.downloaded += self.length_of_piece(i)
+            self.picker.we_have(i)
+        self.status = 'seeding' if self.downloaded == self.size else 'idle'
+        if self.verbose >= 1:
+            print(self.name, "Recheck done. %d/%d pieces" % (self.bitfield.count(), len(self.pieces)))
+
+    def _recheck_failed(self, failure):
+        logging.error("Recheck failed: %s", failure.getErrorMessage())
+        self.status = 'idle'
 
     def give_me_order(self, s):
-        """this method returns piece number to download from s"""
+        """this method returns piece number to download from s(a bitarray)"""
         if self.status == 'seeding':
             return None
-        for t in self.queue[:-1]:
-            u = t & s
-            while u:
-                e, *_ = random.sample(u, 1)
-                u.remove(e)
-                t.remove(e)
-                self.queue[-2].add(e)
-                if not self.bitfield[e]: return e
-        return None
+        return self.picker.pick(s)
+
+    def read_block(self, index, begin, length):
+        """reads length bytes starting at begin of piece index.
+           Data is not verified.
+        """
+        return self.storage.read(index, begin, length)
+
+    def write_block(self, index, begin, data):
+        """writes data at begin of piece index without verifying it"""
+        return self.storage.write(index, begin, data)
+
+    def read_upload_block(self, index, begin, length):
+        """block of a verified piece, from piece cache if possible. A piece
+           which misses twice is read whole and cached, so that pieces of
+           a seeder get cached too, not just downloaded ones.
+        """
+        piece = self.piece_cache.get(index)
+        if piece is None:
+            if not self.piece_cache.missed(index):
+                return self.storage.read(index, begin, length)
+            piece = bytes(self.storage.read(index, 0, self.length_of_piece(index)))
+            if len(piece) == self.length_of_piece(index):
+                self.piece_cache.put(index, piece)
+        return piece[begin:begin+length]
 
     def read_piece(self, index):
         if not (0<= index < len(self.pieces)):
             return None
-        f_index, file_, offset = self.index_to_file(index)
-        piece = bytearray()
-        l = self.piece_length
-        for file_ in self._open_files[f_index:]:
-            file_.seek(offset)
-            data = file_.read(l)
-            l -= len(data)
-            piece.extend(data)
-            if l == 0:
-                break
-            offset = 0
+        piece = self.read_block(index, 0, self.piece_length)
         if hashlib.sha1(piece).digest() == self.pieces[index]:
             if not self.bitfield[index]:
                 self.downloaded += self.length_of_piece(index)
             self.bitfield[index] = True
-            for q in self.queue:
-                if index in q: q.remove(index)
+            self.picker.we_have(index)
         else:
             piece = None
         return piece
@@ -211,6 +366,51 @@ class Torrent(object):
     def progress(self):
         return self.downloaded/self.size
 
+    def finished(self):
+        """True when every piece which is not skipped is downloaded"""
+        if self.downloaded == self.size: return True
+        if Picker.DONT_DOWNLOAD not in self.file_priority: return False
+        priority = self.picker.priority
+        return all(priority[i] == Picker.DONT_DOWNLOAD for i in self.bitfield.search(0))
+
+    def set_file_priority(self, file_index, tier):
+        """tier is one of Picker.HIGHEST..Picker.DONT_DOWNLOAD. A piece
+           shared by files gets highest priority among them.
+        """
+        if not Picker.HIGHEST <= tier <= Picker.DONT_DOWNLOAD:
+            raise ValueError("Invalid priority %r" % tier)
+        self.file_priority[file_index] = tier
+        if self.files[file_index].length == 0: return
+        start, _, end, _ = self.file_to_range(file_index)
+        for index in range(start, end+1):
+            self.picker.set_priority(index, min(self.file_priority[i] for i, _, _
+                                                in self.spans.piece_segments(index)))
+
+    def stats(self):
+        protocols = list(self.current_protocols)
+        return {
+            'name': self.name,
+            'info_hash': self.info_hash_str,
+            'status': self.status,
+            'running': self.running,
+            'progress': self.progress(),
+            'size': self.size,
+            'downloaded': self.downloaded,
+            'downloaded_session': self.downloaded_session,
+            'uploaded_session': self.uploaded_session,
+            'pieces': len(self.pieces),
+            'have': self.bitfield.count(),
+            'peers': len(protocols),
+            'known_peers': len(self.peers),
+            'trackers': self.announcer.describe(),
+            'seeders': self.seeders,
+            'leechers': self.leechers,
+            'download_rate': sum(p.download_rate for p in protocols),
+            'upload_rate': sum(r[1] for r in self.choker.rates.values()),
+            'file_priority': list(self.file_priority),
+            'piece_cache': self.piece_cache.stats(),
+        }
+
     def progress_printer(self):
         prog  = self.progress()
         barlength = math.floor(prog*BAR_LENGTH)
@@ -232,29 +432,51 @@ class Torrent(object):
             reactor.callLater(2, self.progress_printer)
 
     def write_piece(self, index, piece):
-        f_index, file_, offset = self.index_to_file(index)
-        wrote = 0
-        l = self.length_of_piece(index)
+        return self._piece_committed(self._verify_and_write(index, piece), index)
+
+    def commit_piece(self, index, piece):
+        """Verifies and writes piece on disk queue.
+           Returns Deferred which fires with True if piece was correct.
+        """
+        d = self.disk.submit(self._verify_and_write, index, piece)
+        d.addCallbacks(self._piece_committed, self._commit_failed,
+                       callbackArgs=(index, piece), errbackArgs=(index,))
+        return d
+
+    def _commit_failed(self, failure, index):
+        """disk error, piece goes back to picker to be downloaded again"""
+        logging.error("Writing piece %d failed: %s", index, failure.getErrorMessage())
+        self.picker.abort(index)
+        return False
+
+    def _verify_and_write(self, index, piece):
+        """runs in disk thread"""
         if hashlib.sha1(piece).digest() != self.pieces[index]:
+            return False
+        self.write_block(index, 0, piece)
+        return True
+
+    def _piece_committed(self, ok, index, piece=None):
+        if not ok:
             logging.error("Hash didn't match")
+            self.picker.abort(index)
             return False
-        for i in range(f_index, len(self.files)):
-            f = self._open_files[i]
-            f.seek(offset)
-            f_len = self.files[i].length - offset
-            wrote += f.write(piece[wrote:wrote+f_len])
-            offset = 0
+        if piece is not None:
+            self.piece_cache.put(index, piece)
+        self.partial.pop(index, None)
         if not self.bitfield[index]:
             self.bitfield[index] = True
             self.downloaded += self.length_of_piece(index)
             self.downloaded_session += self.length_of_piece(index)
-        for q in self.queue:
-            if index in q: q.remove(index)
+            if self.downloaded == self.size:
+                self.status = 'seeding'
+                self.announcer.completed()
+        self.picker.we_have(index)
         return True
 
     def length_of_piece(self, index):
         """returns a lenth of particular piece in bytes"""
-        if self.pieces[index] != self.pieces[-1]:
+        if index != len(self.pieces) - 1:
             return self.piece_length
         else:
             lop =  self.size % self.piece_length
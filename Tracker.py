@@ -1,12 +1,12 @@
 import struct
 import os
 import enum
-import socket
+from collections import namedtuple
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor, defer
-from twisted.python import log
+from twisted.python import failure
 
-from aux import IpPortPair
+from aux import compact_peers
 from dtoc_exceptions import DTOCFailure
 
 
@@ -20,12 +20,7 @@ def _parse_announce_packet(data):
         raise DTOCFailure('invalid input packet')
 
     unpacked = struct.unpack_from('>i4siii', data)
-
-    no_of_ip_port = (len(data)-20)//6
-    raw_ips = struct.unpack_from(">" + "4sH"*no_of_ip_port, data, 20)
-    ip_ports = set(IpPortPair(socket.inet_ntoa(raw_ips[2*i]), raw_ips[2*i+1])
-                            for i in range(no_of_ip_port))
-    return (*unpacked, ip_ports)
+    return (*unpacked, compact_peers(memoryview(data)[20:]))
 
 def _parse_error_packet(data):
     if len(data) < 8:
@@ -33,7 +28,9 @@ def _parse_error_packet(data):
     return struct.unpack('>i4s%ds' % (len(data)-8), data)
 
 def _parse_scrap_packet(data):
-    pass
+    """returns (action, transaction id, [(seeders, completed, leechers)])"""
+    action, tid = struct.unpack_from('>i4s', data)
+    return action, tid, list(struct.iter_unpack('>iii', data[8:8+(len(data)-8)//12*12]))
 
 _pack_fmt = [
     struct.Struct(">8si4s"),
@@ -54,9 +51,8 @@ def _pack_announce_data(args):
                              args.get("extensions", 0))
 
 def _pack_scrap_data(args):
-    return struct.pack(">qii"+"20b"*len(args['info_hashes']),
-                        args['connection_id'], 2, args['transaction_id'],
-                        *args['info_hashes'])
+    return _pack_fmt[0].pack(args['connection_id'], 2,
+                             args['transaction_id']) + b''.join(args['info_hashes'])
 
 def _pack_data(kwargs):
     return [_pack_connect_data,
@@ -73,141 +69,249 @@ def _parse_packet(data):
             _parse_error_packet][action](data)
 
 
+CONNECT_MAGIC = b"\x00\x00\x04\x17'\x10\x19\x80"
+CONNECTION_ID_LIFETIME = 60 #seconds, as per BEP 15
+RETRANSMIT_TIMEOUT = 15 #seconds, doubled on every retransmission
+MAX_RETRANSMITS = 8
+MAX_SCRAPE_HASHES = 74 #keeps scrape request and reply within 1500 bytes
+
+def parse_udp_url(url):
+    """returns (host, port) of udp://host:port/..."""
+    if not url.startswith('udp://'):
+        raise ValueError("URL should be udp")
+    host, port = url.split('/')[2].rsplit(':', 1)
+    return host, int(port)
+
+#interval and min_interval in seconds, min_interval and counts may be None
+AnnounceResult = namedtuple('AnnounceResult', 'interval min_interval seeders leechers peers')
+
 class TimeOutException(Exception):
     pass
 
-class Messenger(DatagramProtocol):
-    def __init__(self, host, port):
-        self._address = (host, port)
-        self._transaction_id = None
-        self._pkt = None
-        self._defer = None
 
-    def datagramReceived(self, data, address):
-        pkt = _parse_packet(data)
-        action = pkt[0]
-        if pkt[1] != self._transaction_id: return
-        self._transaction_id = None
-        self._pkt = None
-        if self._timer is not None:
-            self._timer.cancel()
-        if self._defer is not None:
-            d = self._defer
-            self._defer = None
-            d.callback(pkt)
-
-    def send_packet(self, **kwargs):
-        if self._defer is not None:
-            self._defer.errback(Exception("Previous call failed due to new call"))
-        self._transaction_id = os.urandom(4)
-        kwargs['transaction_id'] = self._transaction_id
-        self._pkt = _pack_data(kwargs)
-        self._defer = defer.Deferred()
-        self._resend(n = 0)
-        return self._defer
-
-    def _resend(self, n = 0):
-        if self._pkt is None: return
-        if self._defer is None: return
-        if n == 4:
-            d = self._defer
-            self._defer = None
-            self._transaction_id = None
-            d.errback(TimeOutException())
+class _Transaction(object):
+    __slots__ = ('address', 'action', 'args', 'deferred', 'id', 'pkt', 'tries', 'timer')
+
+    def __init__(self, address, action, args, deferred):
+        self.address = address
+        self.action = action
+        self.args = args
+        self.deferred = deferred
+        self.id = None
+        self.pkt = None
+        self.tries = 0
+        self.timer = None
+
+
+class UDPTrackerClient(DatagramProtocol):
+    """UDP tracker protocol(BEP 15) for all trackers of the process over
+       a single socket. Any number of transactions may be outstanding,
+       replies are matched by transaction id. Connection ids are cached
+       per tracker address for their lifetime and requests are
+       retransmitted after timeout*2**n seconds.
+    """
+    def __init__(self, timeout=RETRANSMIT_TIMEOUT, max_retransmits=MAX_RETRANSMITS):
+        self.timeout = timeout
+        self.max_retransmits = max_retransmits
+        self._transactions = {} #transaction id -> _Transaction
+        self._connections = {} #address -> (connection id, expiry time)
+        self._connecting = {} #address -> [_Transaction waiting for connection id]
+
+    def request(self, address, action, **kwargs):
+        """Sends announce(action 1) or scrape(action 2) request to tracker
+           at address (ip, port). Returns Deferred which fires with parsed
+           reply, error replies(action 3) included. Cancelling the
+           Deferred drops the transaction.
+        """
+        txn = _Transaction(address, action, kwargs, None)
+        txn.deferred = defer.Deferred(lambda d: self._drop(txn))
+        self._dispatch(txn)
+        return txn.deferred
+
+    def scrape(self, address, info_hashes):
+        """Scrapes info_hashes from tracker at address, MAX_SCRAPE_HASHES
+           per request. Returns Deferred which fires with
+           {info_hash: (seeders, completed, leechers)} of batches which
+           succeeded, it fails only if all of them failed.
+        """
+        info_hashes = list(info_hashes)
+        batches = [info_hashes[i:i+MAX_SCRAPE_HASHES]
+                   for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES)]
+        ds = []
+        for batch in batches:
+            d = self.request(address, 2, info_hashes=batch)
+            d.addCallback(self._scraped, batch)
+            ds.append(d)
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(self._merge_scrapes)
+
+    def _scraped(self, pkt, batch):
+        if pkt[0] == 3:
+            raise DTOCFailure(pkt[2].decode('utf-8', 'replace'))
+        return dict(zip(batch, pkt[2]))
+
+    def _merge_scrapes(self, results):
+        merged = {}
+        failure = None
+        for ok, result in results:
+            if ok:
+                merged.update(result)
+            else:
+                failure = result
+        if failure is not None and not merged:
+            return failure
+        return merged
+
+    def _connection_id(self, address):
+        cid, expiry = self._connections.get(address, (None, 0))
+        if reactor.seconds() >= expiry: return None
+        return cid
+
+    def _dispatch(self, txn):
+        cid = self._connection_id(txn.address)
+        if cid is None:
+            waiting = self._connecting.get(txn.address)
+            if waiting is None:
+                waiting = self._connecting[txn.address] = []
+                connect = _Transaction(txn.address, 0, {'connection_id': CONNECT_MAGIC}, None)
+                self._send(connect)
+            waiting.append(txn)
+            return
+        txn.args['connection_id'] = cid
+        self._send(txn)
+
+    def _send(self, txn):
+        if txn.id is None:
+            txn.id = os.urandom(4)
+            while txn.id in self._transactions: txn.id = os.urandom(4)
+            self._transactions[txn.id] = txn
+        txn.args['action'] = txn.action
+        txn.args['transaction_id'] = txn.id
+        txn.pkt = _pack_data(txn.args)
+        self.transport.write(txn.pkt, txn.address)
+        txn.timer = reactor.callLater(self.timeout*2**txn.tries, self._timed_out, txn)
+
+    def _timed_out(self, txn):
+        txn.timer = None
+        if txn.tries >= self.max_retransmits:
+            self._finish(txn, failure=TimeOutException(txn.address))
+            return
+        txn.tries += 1
+        if txn.action != 0 and self._connection_id(txn.address) is None:
+            #connection id expired while waiting, get a new one
+            self._transactions.pop(txn.id, None)
+            txn.id = None
+            self._dispatch(txn)
         else:
-            self.transport.write(self._pkt, self._address)
-            self._timer = reactor.callLater(15, self._resend, n+1)
+            self._send(txn)
+
+    def _finish(self, txn, result=None, failure=None):
+        self._transactions.pop(txn.id, None)
+        if txn.timer is not None and txn.timer.active():
+            txn.timer.cancel()
+        txn.timer = None
+        if txn.action == 0:
+            waiting = self._connecting.pop(txn.address, [])
+            for t in waiting:
+                if failure is None:
+                    self._dispatch(t)
+                else:
+                    self._finish(t, failure=failure)
+        elif txn.deferred is not None and not txn.deferred.called:
+            if failure is None:
+                txn.deferred.callback(result)
+            else:
+                txn.deferred.errback(failure)
+
+    def _drop(self, txn):
+        txn.deferred = None
+        self._transactions.pop(txn.id, None)
+        if txn.timer is not None and txn.timer.active():
+            txn.timer.cancel()
+        waiting = self._connecting.get(txn.address)
+        if waiting and txn in waiting: waiting.remove(txn)
 
-
-class UDPTracker:
-    def __init__(self, torrent, url, verbose=None):
+    def datagramReceived(self, data, address):
+        if len(data) < 8: return
+        txn = self._transactions.get(data[4:8])
+        if txn is None or txn.address != address: return
+        try:
+            pkt = _parse_packet(data)
+        except (DTOCFailure, IndexError, struct.error) as e:
+            self._finish(txn, failure=DTOCFailure("Bad reply from %s:%d: %s" % (address + (e,))))
+            return
+        if pkt[0] == 0 and txn.action == 0:
+            self._connections[address] = (pkt[2], reactor.seconds() + CONNECTION_ID_LIFETIME)
+        elif pkt[0] == 3:
+            #may be about a stale connection id
+            self._connections.pop(address, None)
+            if txn.action == 0:
+                self._finish(txn, failure=DTOCFailure(pkt[2].decode('utf-8', 'replace')))
+                return
+        self._finish(txn, pkt)
+
+    def pending(self):
+        return len(self._transactions)
+
+
+_default_client = None
+
+def default_tracker_client():
+    """UDPTrackerClient shared by all trackers of the process"""
+    global _default_client
+    if _default_client is None:
+        _default_client = UDPTrackerClient()
+        reactor.listenUDP(0, _default_client)
+    return _default_client
+
+
+class UDPTracker(object):
+    """Announces torrent to udp://host:port tracker. Scheduling and
+       retries are left to Announcer.Announcer.
+    """
+    EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+    def __init__(self, torrent, url, client=None):
         self._torrent = torrent
-        self._verbose = verbose
-        self.status = "Connecting..."
-        self._connection_id = None
-        self._msngr = None
-        self.seeders = -1 #negative means not connected yet
-        self.leechers = -1
-        if not url.startswith('udp://'):
-            raise ValueError("URL should be udp")
+        self._client = client
+        self.url = url
+        self._host, self._port = parse_udp_url(url)
+        self._address = None
+        self._pending = None
+
+    def announce(self, event=None):
+        """returns Deferred which fires with AnnounceResult"""
+        if self._address is None:
+            d = reactor.resolve(self._host)
+            d.addCallback(self._resolved)
         else:
-            u, p = url.split('/')[2].split(':')
-            if self._verbose > 10: print("Trying to resolve ip for %s"%u)
-            self._url  = url
-            self._port = int(p)
-            reactor.resolve(u).addCallbacks(self._ip_resolved, self._ip_failed)
-
-    def _ip_resolved(self, ip):
-        self._ip = ip
-        if (self._verbose > 10): print("IP resolved for %s" % self._url)
-        self._msngr = Messenger(self._ip, self._port)
-        p = reactor.listenUDP(0, self._msngr)
-        self._start()
-
-    def _ip_failed(self, err):
-        if (self._verbose > 10): print("IP resolved failed %s" % self._url)
-        self.status = "IP resolve failed"
-
-    def _got_connection_id(self, pkt):
-        if pkt[0] != 0: return
-        self._connection_id = pkt[2]
-        reactor.callLater(180, self._do_expire_connection_id)
-        return pkt[2]
-
-    def _do_expire_connection_id(self):
-        self._connection_id = None
-
-    def _timeout_handler(self, err):
-        if self._verbose > 10: print("Server Not Responding: %s"% self._url)
-        self.status = "Server not responding"
-
-    def _get_connection_id(self):
-        d = self._msngr.send_packet(
-                connection_id= b"\x00\x00\x04\x17'\x10\x19\x80",
-                action= 0
-        )
-        d.addCallbacks(self._got_connection_id, self._timeout_handler)
+            d = defer.succeed(None)
+        d.addCallback(self._send, event)
         return d
 
-    def _send_event(self, funct, event = 0):
-        if not self._msngr: return
-        if self.status == 'Server not responding':
-            return
-        if self._connection_id is None:
-            d = self._get_connection_id()
-            d.addCallbacks(funct, self._timeout_handler)
-            return
-        d = self._msngr.send_packet(
-            connection_id=self._connection_id, action=1, event=event,
-            info_hash=self._torrent.info_hash,
-            peer_id=self._torrent.peer_id,
-            downloaded=self._torrent.downloaded_session,
-            left=self._torrent.size - self._torrent.downloaded,
-            uploaded=self._torrent.uploaded_session,
-            key=self._torrent.key, port=self._torrent.port
+    def _resolved(self, ip):
+        self._address = (ip, self._port)
+
+    def _send(self, _, event):
+        t = self._torrent
+        client = self._client or default_tracker_client()
+        self._pending = client.request(
+            self._address, 1, event=self.EVENTS[event],
+            info_hash=t.info_hash, peer_id=t.peer_id,
+            downloaded=t.downloaded_session, left=t.size - t.downloaded,
+            uploaded=t.uploaded_session, key=t.key, port=t.port
         )
-        d.addCallbacks(self._handle_response, log.err)
-
-    def _start(self, *args):
-        if self._verbose > 10: print("Sending start packet :%s"%self._url)
-        self._send_event(self._start, 2)
-
-    def _reannounce(self, *args):
-        if self._verbose > 10: print("Sending reannounce packet :%s"%self._url)
-        self._send_event(self._reannounce, 0)
-
-    def stop(self, *args):
-        if self._verbose > 10: print("Sending Stop packet :%s"%self._url)
-        self._send_event(self.stop, 3)
-
-    def complete(self, *args):
-        self._send_event(self._complete, 1)
-
-    def _handle_response(self, pkt):
+        return self._pending.addBoth(self._done)
+
+    def _done(self, pkt):
+        self._pending = None
+        if isinstance(pkt, failure.Failure):
+            #tracker may have moved
+            if pkt.check(TimeOutException): self._address = None
+            return pkt
         if pkt[0] == 3:
-            self.status = pkt[2].decode('utf-8')
-        elif pkt[0] == 1:
-            self.leechers = pkt[3]
-            self.seeders = pkt[4]
-            if pkt[5]: self._torrent.peer_list_update(pkt[5])
-            reactor.callLater(int(pkt[2]), self._reannounce)
+            raise DTOCFailure(pkt[2].decode('utf-8', 'replace'))
+        _, _, interval, leechers, seeders, peers = pkt
+        return AnnounceResult(interval, None, seeders, leechers, peers)
+
+    def cancel(self):
+        if self._pending is not None: self._pending.cancel()
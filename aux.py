@@ -1,8 +1,27 @@
 from collections import namedtuple, UserDict, deque
+import bisect
+import socket
+import struct
 
 IpPortPair = namedtuple('IpPortPair', 'ip port')
 FileMetaData = namedtuple('FileMetaData', 'path length md5 start')
 
+_compact4 = struct.Struct('>4sH')
+_compact6 = struct.Struct('>16sH')
+
+def compact_peers(data):
+    """set of IpPortPair from compact ip(4 bytes)+port(2 bytes) list"""
+    data = memoryview(data)[:len(data)//6*6]
+    ntoa = socket.inet_ntoa
+    return {IpPortPair(ntoa(ip), port) for ip, port in _compact4.iter_unpack(data)}
+
+def compact_peers6(data):
+    """set of IpPortPair from compact ipv6(16 bytes)+port(2 bytes) list"""
+    data = memoryview(data)[:len(data)//18*18]
+    ntop = socket.inet_ntop
+    return {IpPortPair(ntop(socket.AF_INET6, ip), port)
+            for ip, port in _compact6.iter_unpack(data)}
+
 class MsgCache:
     def __init__(self, max=50):
         self.set = dict()
@@ -13,3 +32,59 @@ class MsgCache:
             self.set.remove(self._list[0])
         self._list.append(msg)
         self.set.add(msg)
+
+class SpanTable:
+    """Maps byte ranges of a torrent to segments of its files.
+
+       starts is cumulative offset of every file, searched with bisect.
+    """
+    def __init__(self, files, piece_length):
+        self.piece_length = piece_length
+        self.lengths = [f.length for f in files]
+        self.starts = [f.start for f in files]
+        self.size = sum(self.lengths)
+
+    def file_at(self, offset):
+        """index of non empty file containing byte offset of torrent"""
+        if not (0 <= offset < self.size):
+            raise ValueError("Offset out of range")
+        return bisect.bisect_right(self.starts, offset) - 1
+
+    def segments(self, offset, length):
+        """returns list of (file index, offset in file, length)"""
+        length = min(length, self.size - offset)
+        if length <= 0: return []
+        i = self.file_at(offset)
+        offset -= self.starts[i]
+        segs = []
+        while length > 0:
+            l = min(self.lengths[i] - offset, length)
+            if l > 0:
+                segs.append((i, offset, l))
+                length -= l
+            i += 1
+            offset = 0
+        return segs
+
+    def piece_segments(self, index, begin=0, length=None):
+        if length is None:
+            length = self.piece_length - begin
+        return self.segments(index*self.piece_length + begin, length)
+
+    def file_to_range(self, file_index):
+        """returns (start_piece, start_offset, end_piece, end_offset).
+           end_offset is exclusive offset into end_piece.
+        """
+        start = self.starts[file_index]
+        end = start + self.lengths[file_index]
+        start_piece, start_offset = divmod(start, self.piece_length)
+        if end == start:
+            return (start_piece, start_offset, start_piece, start_offset)
+        end_piece, end_offset = divmod(end - 1, self.piece_length)
+        return (start_piece, start_offset, end_piece, end_offset + 1)
+
+    def offset_of_index_into_file(self, file_index, index):
+        """offset in file where piece index starts, negative if piece
+           starts before the file.
+        """
+        return index*self.piece_length - self.starts[file_index]
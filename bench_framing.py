@@ -0,0 +1,125 @@
+"""
+    Microbenchmark for BTProtocol.dataReceived message framing.
+
+    Feeds a mixed stream of PIECE, HAVE, REQUEST and keep-alive messages
+    in chunks of different sizes and prints MB/s parsed, next to the
+    bytes concatenation framing dtoc used before.
+"""
+import struct
+import time
+from bitarray import bitarray
+from twisted.internet import defer
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+import PeerProtocol
+import Picker
+import RateLimit
+
+N_PIECES = 64
+PIECE_LENGTH = 0x40000
+BLOCK = PeerProtocol.REQUEST_PIECE_SIZE
+CHUNK_SIZES = (1460, 16384, 65536, 1 << 20)
+ROUNDS = 3
+
+class BenchDisk(object):
+    def register(self, producer): pass
+    def unregister(self, producer): pass
+
+class BenchTorrent(object):
+    """Just enough of Torrent.Torrent for BTProtocol to parse messages."""
+    def __init__(self):
+        self.info_hash = b'\x00'*20
+        self.peer_id = b'-DT0001-000000000000'
+        self.pieces = [b'\x00'*20]*N_PIECES
+        self.piece_length = PIECE_LENGTH
+        self.bitfield = bitarray(N_PIECES)
+        self.bitfield.setall(0)
+        self.picker = Picker.PiecePicker(N_PIECES)
+        self.scheduler = Picker.BlockScheduler(self)
+        self.current_protocols = set()
+        self.partial = {}
+        self.disk = BenchDisk()
+        self.limits = RateLimit.Limits()
+        self.up_bucket = RateLimit.TokenBucket()
+        self.down_bucket = RateLimit.TokenBucket()
+        self.peer_upload_limit = self.peer_download_limit = 0
+
+    def length_of_piece(self, index):
+        return PIECE_LENGTH
+
+    def give_me_order(self, s):
+        return None
+
+    def commit_piece(self, index, piece):
+        return defer.succeed(True)
+
+    def broadcast_have(self, index):
+        pass
+
+def make_stream():
+    block = bytes(range(256))*(BLOCK//256)
+    msgs = []
+    for index in range(N_PIECES):
+        for begin in range(0, PIECE_LENGTH, BLOCK):
+            msgs.append(struct.pack('>IBII', 9+BLOCK, 7, index, begin) + block)
+            msgs.append(struct.pack('>IBI', 5, 4, index))
+            msgs.append(struct.pack('>IBIII', 13, 6, index, begin, BLOCK))
+            msgs.append(b'\x00\x00\x00\x00')
+    return b''.join(msgs)
+
+def chunks(stream, size):
+    return [stream[i:i+size] for i in range(0, len(stream), size)]
+
+class LegacyFramingProtocol(PeerProtocol.BTProtocol):
+    """BTProtocol with bytes concatenation framing dtoc used before"""
+    def dataReceived(self, data):
+        self._buffer_msg = getattr(self, '_buffer_msg', b'') + data
+        while True:
+            if len(self._buffer_msg) < 4:
+                break
+            l, *_ = struct.unpack_from('>I', self._buffer_msg)
+            if len(self._buffer_msg) < 4+l: break
+            msg = self._buffer_msg[4:4+l]
+            self._buffer_msg = self._buffer_msg[4+l:]
+            self._call_msg_handler(msg)
+
+def new_protocol(cls=PeerProtocol.BTProtocol):
+    torrent = BenchTorrent()
+    p = cls(torrent)
+    p.addr = None
+    p.makeConnection(StringTransport())
+    p.state = PeerProtocol.BTProtocolStates.connected
+    now = time.time()
+    for index in range(N_PIECES):
+        torrent.scheduler.pieces[index] = Picker.PartialPiece(index, PIECE_LENGTH)
+        for begin in range(0, PIECE_LENGTH, BLOCK):
+            p._requests[(index, begin)] = (BLOCK, now)
+    return p
+
+def legacy_protocol():
+    return new_protocol(LegacyFramingProtocol)
+
+def bench(factory, pieces):
+    best = None
+    for _ in range(ROUNDS):
+        p = factory()
+        start = time.perf_counter()
+        for c in pieces:
+            p.dataReceived(c)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    stream = make_stream()
+    mb = len(stream)/(1024*1024)
+    print("stream: %.1f MB, %d pieces of %d KiB" % (mb, N_PIECES, PIECE_LENGTH//1024))
+    print("%10s %14s %14s" % ('chunk', 'BTProtocol', 'legacy'))
+    for size in CHUNK_SIZES:
+        pieces = chunks(stream, size)
+        new = bench(new_protocol, pieces)
+        old = bench(legacy_protocol, pieces)
+        print("%10d %9.1f MB/s %9.1f MB/s" % (size, mb/new, mb/old))
@@ -1,18 +1,59 @@
 import argparse
 import logging
-from twisted.internet import reactor
-from twisted.internet.protocol import Factory
 import json
-import tempfile
 import sys
 
-import PeerProtocol
-import Torrent
-from HTTPDownloader import HTTPDownloader
-import dtoc_bencode
+import Metainfo
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+def human_size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024: break
+        n /= 1024
+    else:
+        unit = 'TiB'
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (n, unit)
+
+def inspect(argv):
+    """prints metadata of torrent files, payload and twisted are not touched"""
+    parser = argparse.ArgumentParser(prog='dtoc.py inspect',
+                                     description="Show info_hash, size, pieces and files")
+    parser.add_argument('torrents', nargs='+', help="Paths to .torrent files.")
+    parser.add_argument('--files', help="List files and their sizes", action="store_true")
+    parser.add_argument('--json', help="Print JSON, one object per torrent", action="store_true")
+    args = parser.parse_args(argv)
+    for path in args.torrents:
+        meta = Metainfo.Metainfo.from_file(path)
+        d = meta.describe()
+        if args.files:
+            d['file_list'] = [{'path': '/'.join(p), 'length': l} for p, l, _ in meta.files]
+        if args.json:
+            print(json.dumps(d))
+            continue
+        print("%s\n  info_hash: %s\n  size: %s (%d bytes)\n  pieces: %d x %s\n  files: %d" %
+              (d['name'], d['info_hash'], human_size(d['size']), d['size'],
+               d['pieces'], human_size(d['piece_length']), d['files']))
+        for f in d.get('file_list', ()):
+            print("  %10s  %s" % (human_size(f['length']), f['path']))
+
+def list_files(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('torrent')
+    parser.add_argument('save_to', default='./', nargs='?')
+    args, _ = parser.parse_known_args(argv)
+    for f in Metainfo.Metainfo.from_file(args.torrent).file_metadata(args.save_to):
+        print(f.path)
+
+def download(argv):
+    from twisted.internet import reactor
+    import Torrent
+    import Storage
+    import Choker
+    import RateLimit
+    import Connections
+    import Session
+    from HTTPDownloader import HTTPDownloader
+
+    parser = argparse.ArgumentParser(epilog="Use 'dtoc.py inspect' to show torrent metadata.")
     parser.add_argument('torrent', help="Path to .torrent file.")
     parser.add_argument('save_to', default='./', nargs='?',
                         help="Where to save torrent? defaults to current directory")
@@ -21,25 +62,57 @@ if __name__ == '__main__':
                         default=1, type=int)
     parser.add_argument('--progress', help="Show only progress bar. Verbose will not have any effect",
                         action="store_true")
-    parser.add_argument('--port', help="Port to listen BitTorrent", type=int, default=6891)
+    parser.add_argument('--port', help="Port to listen BitTorrent", type=int,
+                        default=Session.DEFAULT_PORT)
     parser.add_argument('--http', help="file containing json list of urls",
                         type=argparse.FileType('r', encoding="utf-8"))
+    parser.add_argument('--storage', help="Storage backend for piece I/O",
+                        choices=sorted(Storage.BACKENDS), default='file')
+    parser.add_argument('--have_mode', help="Which peers get HAVE messages and when",
+                        choices=Torrent.HAVE_MODES, default='all')
+    parser.add_argument('--upload_slots', help="Peers unchoked at once, one of them optimistically",
+                        type=int, default=Choker.UPLOAD_SLOTS)
+    parser.add_argument('--choke_interval', help="Seconds between rechokes",
+                        type=float, default=Choker.CHOKE_INTERVAL)
+    parser.add_argument('--upload_limit', help="Upload limit to internet peers in KiB/s, 0 is unlimited",
+                        type=int, default=0)
+    parser.add_argument('--download_limit', help="Download limit from internet peers in KiB/s",
+                        type=int, default=0)
+    parser.add_argument('--peer_limit', help="Upload and download limit of every peer in KiB/s",
+                        type=int, default=0)
+    parser.add_argument('--lan_limit', help="Upload and download limit of LAN peers in KiB/s",
+                        type=int, default=0)
+    parser.add_argument('--http_limit', help="Download limit of web seeds in KiB/s",
+                        type=int, default=0)
+    parser.add_argument('--max_peers', help="Connections of this torrent",
+                        type=int, default=Connections.MAX_PEERS)
+    parser.add_argument('--max_half_open', help="Outgoing connects in progress at once",
+                        type=int, default=Connections.MAX_HALF_OPEN)
+    parser.add_argument('--max_active', help="Torrents downloading at once",
+                        type=int, default=Session.MAX_ACTIVE)
+    parser.add_argument('--max_open_files', help="Files kept open or mapped at once by all torrents",
+                        type=int, default=Storage.MAX_OPEN_FILES)
     parser.add_argument('--list_files', help="Only list the files. do not download",
                         action="store_true")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     logging.basicConfig(filename="/tmp/dtoc_log", filemode="w", level=logging.DEBUG)
 
     if args.progress: args.verbose = -10000
-    torrent = Torrent.Torrent(args.torrent, args.save_to, args.name,
-                              args.port, args.verbose)
-
-    if args.list_files:
-        for f in torrent._open_files:
-            f.close()
-        for f in torrent.files:
-            print(f.path)
-        sys.exit(0)
+    Connections.default_budget().max_half_open = args.max_half_open
+    Storage.default_file_pool().max_open = args.max_open_files
+    limits = RateLimit.default_limits()
+    limits.set_limits(RateLimit.PEER, args.upload_limit*1024, args.download_limit*1024)
+    limits.set_limits(RateLimit.LAN, args.lan_limit*1024, args.lan_limit*1024)
+    limits.set_limits(RateLimit.HTTP, download=args.http_limit*1024)
+    session = Session.Session(args.port, args.max_active, args.verbose,
+                              storage=args.storage, have_mode=args.have_mode,
+                              upload_slots=args.upload_slots,
+                              choke_interval=args.choke_interval,
+                              peer_upload_limit=args.peer_limit*1024,
+                              peer_download_limit=args.peer_limit*1024,
+                              max_peers=args.max_peers)
+    torrent = session.add_torrent(args.torrent, args.save_to, name=args.name)
 
     if args.progress:
         reactor.callLater(2, torrent.progress_printer)
@@ -54,8 +127,14 @@ if __name__ == '__main__':
                 httpdownloaders.add(HTTPDownloader(torrent, i, url))
 
 
-    factory = PeerProtocol.BTProtocolFactory(torrent)
-    reactor.listenTCP(args.port, factory)
-    reactor.callLater(1, torrent.start)
-    reactor.addSystemEventTrigger('before', 'shutdown', torrent.stop)
+    reactor.callWhenRunning(session.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', session.stop)
     reactor.run()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['inspect']:
+        inspect(sys.argv[2:])
+    elif '--list_files' in sys.argv:
+        list_files([a for a in sys.argv[1:] if a != '--list_files'])
+    else:
+        download(sys.argv[1:])
@@ -0,0 +1,39 @@
+import argparse
+import logging
+import os
+from twisted.internet import reactor
+
+import Session
+import Daemon
+import Storage
+import Connections
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="dtoc daemon, controlled with "
+                                     "JSON-RPC 2.0 over HTTP on a unix socket")
+    parser.add_argument('--socket', help="Unix socket of control API",
+                        default=Daemon.DEFAULT_SOCKET)
+    parser.add_argument('--port', help="Port to listen BitTorrent", type=int,
+                        default=Session.DEFAULT_PORT)
+    parser.add_argument('--max_active', help="Torrents downloading at once",
+                        type=int, default=Session.MAX_ACTIVE)
+    parser.add_argument('--storage', help="Storage backend for piece I/O",
+                        choices=sorted(Storage.BACKENDS), default='file')
+    parser.add_argument('--max_peers', help="Connections per torrent",
+                        type=int, default=Connections.MAX_PEERS)
+    parser.add_argument('--max_open_files', help="Files kept open or mapped at once by all torrents",
+                        type=int, default=Storage.MAX_OPEN_FILES)
+    parser.add_argument('--log', help="Log file", default="/tmp/dtocd_log")
+    parser.add_argument('--verbose', help="How much of output to display?",
+                        default=0, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log, level=logging.INFO)
+    Storage.default_file_pool().max_open = args.max_open_files
+
+    session = Session.Session(args.port, args.max_active, args.verbose,
+                              storage=args.storage, max_peers=args.max_peers)
+    reactor.callWhenRunning(session.start)
+    reactor.callWhenRunning(Daemon.listen, session, os.path.expanduser(args.socket))
+    reactor.addSystemEventTrigger('before', 'shutdown', session.stop)
+    reactor.run()
@@ -0,0 +1,136 @@
+import unittest
+from unittest import mock
+from twisted.internet import task, defer
+
+import Announcer
+from Tracker import AnnounceResult
+from aux import IpPortPair
+
+class FakeTracker(object):
+    def __init__(self, torrent, url, *args):
+        self.url = url
+        self.events = []
+        self.pending = None
+
+    def announce(self, event=None):
+        self.events.append(event)
+        self.pending = defer.Deferred()
+        return self.pending
+
+    def cancel(self):
+        self.pending.cancel()
+
+    def answer(self, interval=1800, peers=(), min_interval=None):
+        d, self.pending = self.pending, None
+        d.callback(AnnounceResult(interval, min_interval, 1, 2, set(peers)))
+
+    def fail(self):
+        d, self.pending = self.pending, None
+        d.errback(Exception("no"))
+
+
+class FakeTorrent(object):
+    def __init__(self):
+        self.peers = set()
+
+    def peer_list_update(self, peers):
+        self.peers.update(peers)
+
+    def scraped(self, tracker, seeders, completed, leechers):
+        pass
+
+
+class AnnouncerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        patches = [
+            mock.patch.object(Announcer.reactor, 'callLater', self.clock.callLater),
+            mock.patch.object(Announcer.reactor, 'seconds', self.clock.seconds),
+            mock.patch.object(Announcer.Tracker, 'UDPTracker', FakeTracker),
+            mock.patch.object(Announcer.random, 'shuffle', lambda l: None),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.torrent = FakeTorrent()
+        self.announcer = Announcer.Announcer(self.torrent, [['udp://a:1', 'udp://b:1'],
+                                                            ['udp://c:1']])
+        a, b, c = [e.tracker for tier in self.announcer.tiers for e in tier.entries]
+        self.a, self.b, self.c = a, b, c
+
+    def testTiersInParallel(self):
+        self.announcer.start()
+        self.assertEqual(self.a.events, ['started'])
+        self.assertEqual(self.c.events, ['started'])
+        self.assertEqual(self.b.events, [])
+        self.c.answer(peers=[IpPortPair('1.2.3.4', 1)])
+        self.assertEqual(self.torrent.peers, {IpPortPair('1.2.3.4', 1)})
+
+    def testFailoverAndPromote(self):
+        self.announcer.start()
+        self.a.fail()
+        self.assertEqual(self.b.events, ['started'])
+        self.b.answer(interval=100)
+        tier = self.announcer.tiers[0]
+        self.assertEqual([e.url for e in tier.entries], ['udp://b:1', 'udp://a:1'])
+        self.clock.advance(100)
+        self.assertEqual(self.b.events, ['started', None])
+        self.assertEqual(self.a.events, ['started'])
+
+    def testSilentTracker(self):
+        self.announcer.start()
+        self.clock.advance(Announcer.ANNOUNCE_TIMEOUT - 1)
+        self.assertEqual(self.b.events, [])
+        self.clock.advance(1)
+        self.assertEqual(self.b.events, ['started'])
+        self.assertEqual(self.announcer.tiers[0].entries[0].status, 'error')
+        self.b.answer()
+        self.assertEqual(self.announcer.tiers[0].entries[0].url, 'udp://b:1')
+
+    def testBackoff(self):
+        self.announcer.start()
+        self.a.fail()
+        self.b.fail()
+        self.clock.advance(Announcer.RETRY_DELAY - 1)
+        self.assertEqual(len(self.a.events), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.a.events), 2)
+        self.a.fail()
+        self.assertEqual(self.announcer.tiers[0].entries[0].next_try,
+                         self.clock.seconds() + 2*Announcer.RETRY_DELAY)
+
+    def testCompletedInFlight(self):
+        self.announcer.start()
+        self.c.answer()
+        self.announcer.completed()
+        self.assertEqual(self.c.events, ['started', 'completed'])
+        self.assertEqual(self.a.events, ['started'])
+        self.a.answer()
+        self.clock.advance(0)
+        self.assertEqual(self.a.events, ['started', 'completed'])
+        self.a.answer()
+        self.assertIsNone(self.announcer.tiers[0].event)
+
+    def testReannounceMinInterval(self):
+        self.announcer.start()
+        self.a.answer(min_interval=60)
+        self.c.answer()
+        self.clock.advance(10)
+        self.announcer.reannounce()
+        self.assertEqual(self.c.events, ['started', None])
+        self.assertEqual(self.a.events, ['started'])
+        self.clock.advance(49)
+        self.assertEqual(self.a.events, ['started'])
+        self.clock.advance(1)
+        self.assertEqual(self.a.events, ['started', None])
+
+    def testStop(self):
+        self.announcer.start()
+        self.a.answer()
+        self.announcer.stop()
+        self.assertEqual(self.a.events, ['started', 'stopped'])
+        self.assertEqual(self.c.events, ['started']) #never answered
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+if __name__ == '__main__':
+    unittest.main()
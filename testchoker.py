@@ -0,0 +1,85 @@
+import unittest
+
+import Choker
+import PeerProtocol
+
+class FakePeer(object):
+    def __init__(self, interested=True, lndp=False):
+        self.state = PeerProtocol.BTProtocolStates.connected
+        self.peer_interested = interested
+        self.am_choking = True
+        self._is_lndp = lndp
+        self.payload_down = 0
+        self.payload_up = 0
+
+    def _send_choke(self):
+        self.am_choking = True
+
+    def _send_unchoke(self):
+        self.am_choking = False
+
+
+class FakeTorrent(object):
+    def __init__(self, peers, seeding=False):
+        self.current_protocols = set(peers)
+        self.seeding = seeding
+
+    def finished(self):
+        return self.seeding
+
+
+def transfer(peers, down=(), up=()):
+    for p, n in zip(peers, down): p.payload_down += n
+    for p, n in zip(peers, up): p.payload_up += n
+
+
+class ChokerTest(unittest.TestCase):
+    def setUp(self):
+        self.peers = [FakePeer() for _ in range(5)]
+
+    def unchoked(self):
+        return {i for i, p in enumerate(self.peers) if not p.am_choking}
+
+    def testReciprocation(self):
+        choker = Choker.Choker(FakeTorrent(self.peers), slots=3)
+        choker.rechoke(now=0)
+        transfer(self.peers, down=(10, 500, 20, 400, 0))
+        choker.rechoke(now=10)
+        unchoked = self.unchoked()
+        self.assertEqual(len(unchoked), 3)
+        self.assertTrue({1, 3} <= unchoked)
+
+    def testSeedingUsesUploadRate(self):
+        choker = Choker.Choker(FakeTorrent(self.peers, seeding=True), slots=2)
+        choker.rechoke(now=0)
+        transfer(self.peers, down=(900, 0, 0, 0, 0), up=(0, 0, 0, 300, 0))
+        choker.rechoke(now=10)
+        self.assertIn(3, self.unchoked())
+        self.assertEqual(len(self.unchoked()), 2)
+
+    def testOptimisticRotates(self):
+        choker = Choker.Choker(FakeTorrent(self.peers), slots=1, optimistic_rounds=1)
+        seen = set()
+        for t in range(50):
+            choker.rechoke(now=t)
+            self.assertEqual(len(self.unchoked()), 1)
+            seen |= self.unchoked()
+        self.assertGreater(len(seen), 1)
+
+    def testUninterestedAndLanPeers(self):
+        self.peers[0].peer_interested = False
+        self.peers[1]._is_lndp = True
+        choker = Choker.Choker(FakeTorrent(self.peers), slots=2)
+        choker.rechoke(now=0)
+        self.assertNotIn(0, self.unchoked())
+        self.assertIn(1, self.unchoked())
+
+    def testInterestedUsesFreeSlot(self):
+        choker = Choker.Choker(FakeTorrent(self.peers), slots=2)
+        choker.peer_interested(self.peers[0])
+        choker.peer_interested(self.peers[1])
+        choker.peer_interested(self.peers[2])
+        self.assertEqual(self.unchoked(), {0, 1})
+
+if __name__ == '__main__':
+    unittest.main()
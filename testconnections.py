@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+
+import Connections
+import PeerProtocol
+import PeerStore
+from aux import IpPortPair
+
+class FakeConnector(object):
+    def stopConnecting(self): pass
+
+class FakeProtocol(object):
+    def __init__(self, payload_down=0):
+        self.state = PeerProtocol.BTProtocolStates.connected
+        self.payload_down = payload_down
+
+class FakeTorrent(object):
+    def __init__(self):
+        self.current_protocols = set()
+        self.connections = set()
+        self.running = True
+
+    def progress(self):
+        return 0.5
+
+    def finished(self):
+        return False
+
+
+class ConnectionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.connects = []
+        patches = [
+            mock.patch.object(Connections.reactor, 'seconds', lambda: self.now),
+            mock.patch.object(Connections.reactor, 'connectTCP', self.connect),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.torrent = FakeTorrent()
+        self.budget = Connections.ConnectionBudget(max_peers=10, max_half_open=2)
+        self.manager = Connections.ConnectionManager(self.torrent, 4, self.budget)
+        self.budget.managers.add(self.manager)
+        self.addrs = [IpPortPair('10.0.0.%d' % i, 6881) for i in range(6)]
+        self.manager.add_peers(self.addrs)
+
+    def connect(self, host, port, factory, timeout):
+        self.connects.append(IpPortPair(host, port))
+        return FakeConnector()
+
+    def testHalfOpenCap(self):
+        self.manager.connect_peers()
+        self.assertEqual(len(self.connects), 2)
+        self.manager.connect_peers()
+        self.assertEqual(len(self.connects), 2)
+        self.manager.connect_failed(self.connects[0])
+        self.manager.connect_peers()
+        self.assertEqual(len(self.connects), 3)
+
+    def testBackoff(self):
+        addr = self.addrs[0]
+        self.manager.connect_failed(addr)
+        self.manager.connect_failed(addr)
+        info = self.manager.peers[addr]
+        self.assertEqual(info.next_try, self.now + 2*Connections.BACKOFF)
+        for _ in range(Connections.MAX_FAILURES):
+            self.manager.connect_failed(addr)
+        self.assertNotIn(addr, self.manager.peers)
+
+    def testFastestFirst(self):
+        fast, slow = self.addrs[4], self.addrs[5]
+        for addr, down in ((slow, 1000), (fast, 100000)):
+            p = FakeProtocol(down)
+            self.manager.connected(addr, p)
+            self.now += 10
+            self.manager.disconnected(addr, p)
+        self.now += Connections.RECONNECT_DELAY
+        self.manager.connect_peers()
+        self.assertEqual(self.connects, [fast, slow])
+
+    def testDropBeforeHandshake(self):
+        store = self.manager.store = PeerStore.PeerStore()
+        addr = self.addrs[0]
+        p = FakeProtocol()
+        p.state = PeerProtocol.BTProtocolStates.handshake_sent
+        self.manager.connected(addr, p)
+        self.manager.disconnected(addr, p)
+        self.assertEqual(store.best(10), [])
+        for _ in range(PeerStore.MAX_FAILURES):
+            self.manager.connect_failed(addr)
+        self.assertEqual(len(store), 0)
+
+    def testPeerLimit(self):
+        self.budget.max_half_open = 10
+        for _ in range(3): self.torrent.current_protocols.add(FakeProtocol())
+        self.manager.connect_peers()
+        self.assertEqual(len(self.connects), 1)
+        self.assertFalse(self.manager.accept_incoming())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import io
+import json
+import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+import Daemon
+import RateLimit
+import Session
+
+class ControlTest(unittest.TestCase):
+    def setUp(self):
+        self.session = Session.Session(limits=RateLimit.Limits())
+        self.resource = Daemon.ControlResource(Daemon.Control(self.session))
+
+    def call(self, method, params=None, rid=1):
+        req = {'jsonrpc': '2.0', 'id': rid, 'method': method}
+        if params is not None: req['params'] = params
+        return self.resource._handle(req)
+
+    def testSessionStats(self):
+        resp = self.call('session_stats')
+        self.assertEqual(resp['id'], 1)
+        self.assertEqual(resp['result']['torrents'], 0)
+
+    def testErrors(self):
+        self.assertEqual(self.call('nope')['error']['code'], Daemon.METHOD_NOT_FOUND)
+        self.assertEqual(self.call('stats', ['00'*20])['error']['code'], Daemon.INVALID_PARAMS)
+        self.assertEqual(self.call('pause', {'bad': 1})['error']['code'], Daemon.INVALID_PARAMS)
+        self.assertEqual(self.resource._handle([])['error']['code'], Daemon.INVALID_REQUEST)
+
+    def post(self, body):
+        request = DummyRequest([b''])
+        request.method = b'POST'
+        request.content = io.BytesIO(json.dumps(body).encode('utf-8'))
+        data = self.resource.render_POST(request)
+        return request.responseCode, json.loads(data) if data else None
+
+    def testBatches(self):
+        code, resp = self.post([])
+        self.assertEqual(resp['error']['code'], Daemon.INVALID_REQUEST)
+        note = {'jsonrpc': '2.0', 'method': 'session_stats'}
+        self.assertEqual(self.post(note), (204, None))
+        self.assertEqual(self.post([note, note]), (204, None))
+        code, resp = self.post([note, {'jsonrpc': '2.0', 'id': 7, 'method': 'session_stats'}, 1])
+        self.assertEqual([r['id'] for r in resp], [7, None])
+        self.assertEqual(resp[1]['error']['code'], Daemon.INVALID_REQUEST)
+
+    def testMaxActive(self):
+        self.assertEqual(self.call('set_max_active', ['5'])['error']['code'],
+                         Daemon.INVALID_PARAMS)
+        self.assertEqual(self.call('set_max_active', [-1])['error']['code'],
+                         Daemon.INVALID_PARAMS)
+        self.assertEqual(self.session.max_active, Session.MAX_ACTIVE)
+        self.assertTrue(self.call('set_max_active', [3])['result'])
+        self.assertEqual(self.session.max_active, 3)
+
+    def testSessionLimits(self):
+        resp = self.call('set_limits', {'upload': 1000, 'cls': RateLimit.LAN})
+        self.assertTrue(resp['result'])
+        self.assertEqual(self.session.limits.up[RateLimit.LAN].rate, 1000)
+        self.assertEqual(self.session.limits.up[RateLimit.PEER].rate, 0)
+
+if __name__ == '__main__':
+    unittest.main()
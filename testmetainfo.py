@@ -0,0 +1,28 @@
+import hashlib
+import unittest
+
+import dtoc_bencode
+from Metainfo import Metainfo
+
+class MetainfoTest(unittest.TestCase):
+    def setUp(self):
+        self.info = {b'name': b'dir', b'piece length': 16, b'pieces': b'a'*20 + b'b'*20,
+                     b'files': [{b'path': [b'x', b'y'], b'length': 10},
+                                {b'path': [b'z'], b'length': 20}]}
+        self.meta = Metainfo({b'announce': b'udp://t:1', b'info': self.info})
+
+    def testFields(self):
+        m = self.meta
+        self.assertEqual(m.info_hash, hashlib.sha1(dtoc_bencode.bencode(self.info)).digest())
+        self.assertEqual(m.file_mode, 'multi')
+        self.assertEqual(m.size, 30)
+        self.assertEqual(m.pieces, [b'a'*20, b'b'*20])
+        self.assertEqual([f[0] for f in m.files], [('dir', 'x', 'y'), ('dir', 'z')])
+
+    def testFileMetadata(self):
+        files = self.meta.file_metadata('/save')
+        self.assertEqual([(f.path, f.start) for f in files],
+                         [('/save/dir/x/y', 0), ('/save/dir/z', 10)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import struct
+import unittest
+from unittest import mock
+from bitarray import bitarray
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+import dtoc_bencode
+import PeerProtocol
+import Picker
+import RateLimit
+
+N_PIECES = 4
+PIECE_LENGTH = 4*Picker.BLOCK_SIZE
+
+class FakeDisk(object):
+    def register(self, producer): pass
+    def unregister(self, producer): pass
+
+class FakeTorrent(object):
+    def __init__(self):
+        self.info_hash = b'\x00'*20
+        self.peer_id = b'-DT0001-000000000000'
+        self.pieces = [b'\x00'*20]*N_PIECES
+        self.piece_length = PIECE_LENGTH
+        self.bitfield = bitarray(N_PIECES)
+        self.bitfield.setall(0)
+        self.picker = Picker.PiecePicker(N_PIECES)
+        self.scheduler = Picker.BlockScheduler(self)
+        self.current_protocols = set()
+        self.partial = {}
+        self.disk = FakeDisk()
+        self.limits = RateLimit.Limits()
+        self.up_bucket = RateLimit.TokenBucket()
+        self.down_bucket = RateLimit.TokenBucket()
+        self.peer_upload_limit = self.peer_download_limit = 0
+
+    def length_of_piece(self, index):
+        return PIECE_LENGTH
+
+    def give_me_order(self, s):
+        return self.picker.pick(s)
+
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patches = [
+            mock.patch.object(PeerProtocol.time, 'time', lambda: self.now),
+            mock.patch.object(PeerProtocol.reactor, 'callLater', mock.Mock()),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.torrent = FakeTorrent()
+        self.slow = self.new_peer()
+        self.other = self.new_peer()
+
+    def new_peer(self):
+        p = PeerProtocol.BTProtocol(self.torrent)
+        p.addr = None
+        p.makeConnection(StringTransport())
+        p.state = PeerProtocol.BTProtocolStates.connected
+        p.peer_choking = False
+        p.peer_bitfield.setall(1)
+        self.torrent.picker.peer_bitfield(p.peer_bitfield)
+        return p
+
+    def testSnubReleasesBlocks(self):
+        self.slow.do_download()
+        blocks = set(self.slow._requests)
+        self.assertEqual(len(blocks), PeerProtocol.MIN_REQUESTS)
+        self.now += PeerProtocol.SNUB_TIME + 1
+        self.slow._last_received = self.now
+        self.slow._tick()
+        self.assertTrue(self.slow.snubbed)
+        self.assertEqual(len(self.slow._requests), 1)
+        self.assertTrue(blocks & set(self.other._requests))
+
+    def testBlockClearsSnub(self):
+        self.slow.snubbed = True
+        self.slow.do_download()
+        (index, begin), = self.slow._requests
+        self.slow._handle_piece(memoryview(struct.pack('>II', index, begin) +
+                                           b'\x00'*Picker.BLOCK_SIZE))
+        self.assertFalse(self.slow.snubbed)
+
+    def testWrongLengthReleased(self):
+        self.slow.do_download()
+        index, begin = next(iter(self.slow._requests))
+        self.slow._handle_piece(memoryview(struct.pack('>II', index, begin) + b'\x00'*10))
+        self.assertNotIn((index, begin), self.slow._requests)
+        pp = self.torrent.scheduler.pieces[index]
+        self.assertEqual(pp.blocks[begin//Picker.BLOCK_SIZE], Picker.PartialPiece.FREE)
+
+    def testQueueFollowsRate(self):
+        self.slow.download_rate = 100*1024
+        depth = self.slow.desired_queue()
+        self.assertEqual(depth, 13)
+        self.slow.do_download()
+        #blocks which waited behind others don't deepen the queue
+        self.now += 20
+        for index, begin in list(self.slow._requests)[:3]:
+            self.slow._handle_piece(memoryview(struct.pack('>II', index, begin) +
+                                               b'\x00'*Picker.BLOCK_SIZE))
+        self.assertLessEqual(self.slow.desired_queue(), depth)
+
+    def testIncomingLanPeer(self):
+        self.torrent.lndp = mock.Mock()
+        p = self.new_peer()
+        p.type = 1
+        p._handle_ltep_handshake(dtoc_bencode.bencode({'m': {'dt_lndp': 1}}))
+        self.assertTrue(p._is_lndp)
+        self.assertIn(self.torrent.limits.up[RateLimit.LAN], p._up_chain.buckets)
+        self.assertNotIn(self.torrent.up_bucket, p._up_chain.buckets)
+        self.torrent.lndp.send_handshake.assert_called_once_with(p)
+
+    def testIdleDisconnectAndKeepAlive(self):
+        self.now += PeerProtocol.KEEP_ALIVE_INTERVAL + 1
+        self.slow._last_received = self.now
+        self.slow._tick()
+        self.assertIn(b'\x00\x00\x00\x00', b''.join(bytes(p) for p in self.slow._out))
+        self.now += PeerProtocol.IDLE_TIMEOUT + 1
+        self.slow._tick()
+        self.assertTrue(self.slow.transport.disconnecting)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import PeerStore
+from aux import IpPortPair
+
+class PeerStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'x.peers')
+
+    def testPack(self):
+        for addr in (IpPortPair('10.1.2.3', 6881), IpPortPair('2001:db8::1', 51413)):
+            key = PeerStore.pack_peer(addr)
+            self.assertIn(len(key), (6, 18))
+            self.assertEqual(PeerStore.unpack_peer(key), addr)
+
+    def testPersistBest(self):
+        store = PeerStore.PeerStore(self.path)
+        slow, fast, bad, unknown = [IpPortPair('10.0.0.%d' % i, 1) for i in range(4)]
+        store.seen([slow, fast, bad, unknown])
+        for addr, rate in ((slow, 10), (fast, 1000)):
+            store.connected(addr)
+            store.rated(addr, rate)
+        store.failed(bad)
+        store.save()
+        store = PeerStore.PeerStore(self.path)
+        self.assertEqual(len(store), 4)
+        self.assertEqual([addr for addr, _ in store.best(10)], [fast, slow])
+
+    def testForgetFailing(self):
+        store = PeerStore.PeerStore()
+        addr = IpPortPair('10.0.0.1', 1)
+        for _ in range(PeerStore.MAX_FAILURES + 1): store.failed(addr)
+        self.assertEqual(len(store), 0)
+
+    def testHostname(self):
+        store = PeerStore.PeerStore()
+        addr = IpPortPair('tracker.example.org', 6881)
+        store.seen([addr])
+        store.connected(addr)
+        store.rated(addr, 100)
+        store.failed(addr)
+        self.assertEqual(len(store), 0)
+
+if __name__ == '__main__':
+    unittest.main()
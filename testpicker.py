@@ -0,0 +1,113 @@
+import unittest
+from bitarray import bitarray
+
+import Picker
+
+def bits(s):
+    return bitarray(s)
+
+class PiecePickerTest(unittest.TestCase):
+    def setUp(self):
+        self.picker = Picker.PiecePicker(4)
+        self.picker.peer_bitfield(bits('1111'))
+        self.picker.peer_bitfield(bits('1101'))
+        self.picker.peer_bitfield(bits('1001'))
+
+    def testRarestFirst(self):
+        self.assertEqual(self.picker.pick(bits('1111')), 2)
+        self.assertEqual(self.picker.pick(bits('1111')), 1)
+
+    def testOnlyPiecesPeerHas(self):
+        picked = {self.picker.pick(bits('1001')), self.picker.pick(bits('1001'))}
+        self.assertEqual(picked, {0, 3})
+        self.assertEqual(self.picker.pick(bits('1001')), None)
+
+    def testPriorityBeforeRarity(self):
+        self.picker.set_priority(0, Picker.HIGHEST)
+        self.picker.set_priority(2, Picker.DONT_DOWNLOAD)
+        self.assertEqual(self.picker.pick(bits('1111')), 0)
+        self.assertEqual(self.picker.pick(bits('1111')), 1)
+
+    def testAbortAndHave(self):
+        index = self.picker.pick(bits('1111'))
+        self.picker.abort(index)
+        self.assertEqual(self.picker.pick(bits('1111')), index)
+        self.picker.we_have(1)
+        self.assertIn(self.picker.pick(bits('1111')), (0, 3))
+
+    def testPeerLost(self):
+        self.picker.peer_lost(bits('1111'))
+        self.assertEqual(self.picker.pick(bits('1111')), 1)
+        self.picker.peer_lost(bits('1101'))
+        self.assertEqual(self.picker.pick(bits('1111')), 0)
+
+    def testEndgame(self):
+        self.assertFalse(self.picker.in_endgame())
+        for _ in range(4): self.picker.pick(bits('1111'))
+        self.assertTrue(self.picker.in_endgame())
+        self.picker.endgame_threshold = 3
+        self.assertFalse(self.picker.in_endgame())
+
+
+class FakeTorrent(object):
+    def __init__(self, n, piece_length):
+        self.picker = Picker.PiecePicker(n)
+        self.partial = {}
+        self.piece_length = piece_length
+
+    def length_of_piece(self, index):
+        return self.piece_length
+
+    def give_me_order(self, s):
+        return self.picker.pick(s)
+
+class FakePeer(object):
+    def __init__(self, bitfield):
+        self.peer_bitfield = bits(bitfield)
+        self.cancelled = []
+
+    def _cancel_block(self, index, begin, length):
+        self.cancelled.append((index, begin))
+
+class BlockSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.torrent = FakeTorrent(2, 3*Picker.BLOCK_SIZE)
+        self.scheduler = Picker.BlockScheduler(self.torrent)
+        self.a = FakePeer('11')
+        self.b = FakePeer('11')
+        for p in (self.a, self.b):
+            self.torrent.picker.peer_bitfield(p.peer_bitfield)
+
+    def testPeersShareAPiece(self):
+        first = self.scheduler.request_blocks(self.a, 2)
+        second = self.scheduler.request_blocks(self.b, 2)
+        self.assertEqual([i for i, _, _ in first], [first[0][0]]*2)
+        self.assertEqual(second[0][0], first[0][0])
+        self.assertNotEqual(second[1][0], first[0][0])
+
+    def testPieceCompletes(self):
+        blocks = self.scheduler.request_blocks(self.a, 3)
+        data = b'x'*Picker.BLOCK_SIZE
+        for index, begin, _ in blocks[:2]:
+            self.assertIsNone(self.scheduler.block_received(self.a, index, begin, data))
+        index, begin, _ = blocks[2]
+        pp = self.scheduler.block_received(self.a, index, begin, data)
+        self.assertEqual(pp.buffer, data*3)
+        self.assertNotIn(index, self.scheduler.pieces)
+
+    def testReleaseReturnsBlocks(self):
+        blocks = self.scheduler.request_blocks(self.a, 3)
+        self.scheduler.release(self.a, [(i, b) for i, b, _ in blocks])
+        self.assertEqual(self.scheduler.request_blocks(self.b, 3), blocks)
+
+    def testEndgameDuplicatesAndCancels(self):
+        blocks = self.scheduler.request_blocks(self.a, 6)
+        dup = self.scheduler.request_blocks(self.b, 6)
+        self.assertEqual(sorted(dup), sorted(blocks))
+        index, begin, _ = dup[0]
+        self.scheduler.block_received(self.b, index, begin, b'x'*Picker.BLOCK_SIZE)
+        self.assertEqual(self.a.cancelled, [(index, begin)])
+
+
+if __name__ == "__main__":
+    unittest.main()
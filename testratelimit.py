@@ -0,0 +1,33 @@
+import unittest
+
+import RateLimit
+
+class TokenBucketTest(unittest.TestCase):
+    def testUnlimited(self):
+        b = RateLimit.TokenBucket()
+        b.consume(10**9, b._last)
+        self.assertEqual(b.delay(b._last), 0)
+
+    def testDebtAndRefill(self):
+        b = RateLimit.TokenBucket(1000)
+        t = b._last
+        b.consume(1500, t)
+        self.assertAlmostEqual(b.delay(t), 0.5)
+        self.assertEqual(b.delay(t + 0.6), 0)
+
+    def testBurstIsCapped(self):
+        b = RateLimit.TokenBucket(1000, burst=2)
+        t = b._last
+        b.delay(t + 100)
+        self.assertEqual(b.tokens, 2000)
+
+    def testChainSlowestDecides(self):
+        fast = RateLimit.TokenBucket(10000)
+        slow = RateLimit.TokenBucket(100)
+        chain = RateLimit.Chain(fast, None, slow)
+        chain.consume(200)
+        self.assertGreater(chain.delay(), 0.5)
+        self.assertLess(fast.tokens, fast.capacity)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+from twisted.internet import defer
+
+import aux
+import Recheck
+
+PIECE_LENGTH = 8
+
+class FakeTorrent(object):
+    def __init__(self, files, data):
+        self.files = files
+        self.spans = aux.SpanTable(files, PIECE_LENGTH)
+        self.pieces = [hashlib.sha1(data[i:i+PIECE_LENGTH]).digest()
+                       for i in range(0, len(data), PIECE_LENGTH)]
+
+class SyncPool(Recheck.RecheckPool):
+    """runs jobs at once in calling thread"""
+    def submit(self, f, *args):
+        future = Future()
+        future.set_result(f(*args))
+        return future
+
+
+class RecheckTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        #pieces are in files 0, 0+1, 1+2 and 2, file 2 is missing
+        lengths = [12, 8, 12]
+        self.data = b''.join(bytes([65+i])*l for i, l in enumerate(lengths))
+        self.files, start = [], 0
+        for i, l in enumerate(lengths):
+            path = os.path.join(self.dir, str(i))
+            self.files.append(aux.FileMetaData(path, l, None, start))
+            if i < 2:
+                with open(path, 'wb') as f: f.write(self.data[start:start+l])
+            start += l
+        self.torrent = FakeTorrent(self.files, self.data)
+        patch = mock.patch.object(Recheck.reactor, 'callFromThread',
+                                  lambda f, *args: f(*args))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def testSpanningAndMissingFiles(self):
+        t = self.torrent
+        job = list(enumerate(t.pieces))
+        verified = Recheck.hash_pieces([f.path for f in self.files], t.spans, job)
+        self.assertEqual(verified, [0, 1])
+
+    def testEngine(self):
+        progress = []
+        engine = Recheck.RecheckEngine(self.torrent, SyncPool(),
+                                       lambda done, total: progress.append(done))
+        result = []
+        engine.check().addCallback(result.append)
+        self.assertEqual(result, [{0, 1}])
+        self.assertEqual(progress, [4])
+
+    def testChecksWaitForSlot(self):
+        pool = Recheck.RecheckPool(max_checks=1)
+        first, second = defer.Deferred(), defer.Deferred()
+        started = []
+        pool.run(lambda: started.append(1) or first)
+        pool.run(lambda: started.append(2) or second)
+        self.assertEqual(started, [1])
+        first.callback(None)
+        self.assertEqual(started, [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from bitarray import bitarray
+
+import Metainfo
+import Picker
+import Resume
+import Torrent
+
+PIECE_LENGTH = 2*Picker.BLOCK_SIZE
+LENGTHS = [40*1024, 56*1024] #piece 1 is in both files
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        data = os.urandom(sum(LENGTHS))
+        pieces = b''.join(hashlib.sha1(data[i:i+PIECE_LENGTH]).digest()
+                          for i in range(0, len(data), PIECE_LENGTH))
+        self.meta = Metainfo.Metainfo({b'info': {
+            b'name': b't', b'piece length': PIECE_LENGTH, b'pieces': pieces,
+            b'files': [{b'path': [b'%d' % i], b'length': l} for i, l in enumerate(LENGTHS)]}})
+        self.files = self.meta.file_metadata(self.dir)
+        os.mkdir(os.path.join(self.dir, 't'))
+        start = 0
+        for f in self.files:
+            with open(f.path, 'wb') as fo: fo.write(data[start:start+f.length])
+            start += f.length
+        self.path = Resume.resume_path(self.dir, self.meta.info_hash_str)
+        bitfield = bitarray('101')
+        Resume.save(self.path, self.meta.info_hash, bitfield, self.files,
+                    {1: Picker.BLOCK_SIZE})
+
+    def load(self):
+        return Resume.load(self.path, self.meta.info_hash, 3, 2)
+
+    def torrent(self):
+        t = Torrent.Torrent(self.meta, self.dir, verbose=0, resume_dir=self.dir)
+        self.addCleanup(t.close)
+        return t
+
+    def testStale(self):
+        self.assertIsNotNone(self.load())
+        self.assertIsNone(Resume.load(self.path, b'\x00'*20, 3, 2))
+        self.assertIsNone(Resume.load(self.path, self.meta.info_hash, 4, 2))
+        self.assertIsNone(Resume.load(self.path, self.meta.info_hash, 3, 1))
+
+    def testChangedFile(self):
+        st = os.stat(self.files[1].path)
+        os.utime(self.files[1].path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(Resume.changed_files(self.load(), self.files), [1])
+        with mock.patch.object(Torrent.Torrent, 'force_recheck') as recheck:
+            t = self.torrent()
+        recheck.assert_called_once_with({1, 2})
+        self.assertEqual(t.bitfield, bitarray('100'))
+        self.assertEqual(t.partial, {})
+
+    def testPartialRestored(self):
+        self.assertEqual(Resume.changed_files(self.load(), self.files), [])
+        t = self.torrent()
+        self.assertEqual(t.status, 'idle')
+        self.assertEqual(t.bitfield, bitarray('101'))
+        self.assertEqual(t.partial, {1: Picker.BLOCK_SIZE})
+        pp = t.scheduler._new_piece(1)
+        self.assertEqual(pp.prefix(), Picker.BLOCK_SIZE)
+        self.assertEqual(bytes(pp.buffer[:Picker.BLOCK_SIZE]),
+                         bytes(t.read_block(1, 0, Picker.BLOCK_SIZE)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from unittest import mock
+from twisted.internet import task
+
+import Session
+
+class FakeConnections(object):
+    def accept_incoming(self):
+        return True
+
+class FakeTorrent(object):
+    def __init__(self, progress=0.5):
+        self.status = 'idle'
+        self.running = False
+        self.name = 'fake'
+        self._progress = progress
+        self.conn_manager = FakeConnections()
+        self.seeders = -1
+        self.scrapes = {}
+
+    def progress(self):
+        return self._progress
+
+    def scraped(self, tracker, seeders, completed, leechers):
+        self.scrapes[tracker] = (seeders, completed, leechers)
+
+    def finished(self):
+        return self._progress == 1.0
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+def make_meta(info_hash):
+    return mock.Mock(spec=Session.Metainfo.Metainfo, info_hash=info_hash,
+                     info_hash_str=info_hash.hex())
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.session = Session.Session(max_active=2)
+        self.session._listeners = [None] #as if started
+        self.torrents = {}
+        for n, progress in enumerate((0.5, 1.0, 0.1, 0.0)):
+            info_hash = bytes([n])*20
+            self.torrents[info_hash] = self.session.torrents[info_hash] = FakeTorrent(progress)
+        self.hashes = list(self.torrents)
+
+    def states(self):
+        return [self.session.state(h) for h in self.hashes]
+
+    def testActiveLimit(self):
+        self.session._schedule()
+        self.assertEqual(self.states(), ['downloading', 'seeding', 'downloading', 'queued'])
+
+    def testPauseFreesSlot(self):
+        self.session._schedule()
+        self.session.pause(self.hashes[0])
+        self.assertEqual(self.states(), ['paused', 'seeding', 'downloading', 'downloading'])
+        self.session.resume(self.hashes[0])
+        self.assertEqual(self.states()[0], 'downloading')
+
+    def testDeadSwarmLast(self):
+        self.torrents[self.hashes[0]].seeders = 0
+        self.session._schedule()
+        self.assertEqual(self.states(), ['queued', 'seeding', 'downloading', 'downloading'])
+
+    def testScrapeKeyedByUrl(self):
+        h = self.hashes[0]
+        url = 'udp://t.example:6969/announce'
+        self.session._scraped({h: (5, 1, 2)}, {h: [url]})
+        self.assertEqual(self.torrents[h].scrapes, {url: (5, 1, 2)})
+
+    def testScrapeAdded(self):
+        clock = task.Clock()
+        scraped = []
+        def make(path, save_path, **kwargs):
+            t = FakeTorrent()
+            t.info_hash = path.info_hash
+            return t
+        with mock.patch.object(Session.reactor, 'callLater', clock.callLater), \
+             mock.patch.object(Session.Torrent, 'Torrent', make), \
+             mock.patch.object(self.session, 'scrape', scraped.append):
+            self.session.add_torrent(make_meta(b'a'*20))
+            self.session.add_torrent(make_meta(b'b'*20))
+            clock.advance(Session.SCRAPE_DELAY)
+        self.assertEqual(scraped, [{b'a'*20, b'b'*20}])
+
+    def testDuplicateRejectedFirst(self):
+        with mock.patch.object(Session.Torrent, 'Torrent') as torrent:
+            self.assertRaises(Session.DTOCFailure, self.session.add_torrent,
+                              make_meta(self.hashes[0]))
+        torrent.assert_not_called()
+
+    def testRoute(self):
+        self.session._schedule()
+        self.assertIs(self.session.route(self.hashes[1]), self.torrents[self.hashes[1]])
+        self.assertIsNone(self.session.route(self.hashes[3]))
+        self.assertIsNone(self.session.route(b'\xff'*20))
+
+if __name__ == '__main__':
+    unittest.main()
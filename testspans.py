@@ -0,0 +1,38 @@
+import unittest
+
+from aux import FileMetaData, SpanTable
+
+def make_files(lengths):
+    files, start = [], 0
+    for i, l in enumerate(lengths):
+        files.append(FileMetaData('f%d' % i, l, None, start))
+        start += l
+    return files
+
+class SpanTableTest(unittest.TestCase):
+    def setUp(self):
+        self.spans = SpanTable(make_files([10, 0, 5, 20, 0]), 8)
+
+    def testSegmentsSpanFiles(self):
+        self.assertEqual(self.spans.piece_segments(1), [(0, 8, 2), (2, 0, 5), (3, 0, 1)])
+        self.assertEqual(self.spans.piece_segments(4), [(3, 17, 3)])
+
+    def testBlockSegments(self):
+        self.assertEqual(self.spans.piece_segments(1, 3, 4), [(2, 1, 4)])
+
+    def testFileAt(self):
+        self.assertEqual(self.spans.file_at(10), 2)
+        self.assertRaises(ValueError, self.spans.file_at, 35)
+
+    def testFileToRange(self):
+        self.assertEqual(self.spans.file_to_range(0), (0, 0, 1, 2))
+        self.assertEqual(self.spans.file_to_range(1), (1, 2, 1, 2))
+        self.assertEqual(self.spans.file_to_range(3), (1, 7, 4, 3))
+
+    def testOffsetOfIndexIntoFile(self):
+        self.assertEqual(self.spans.offset_of_index_into_file(3, 2), 1)
+        self.assertEqual(self.spans.offset_of_index_into_file(3, 0), -15)
+
+
+if __name__ == "__main__":
+    unittest.main()
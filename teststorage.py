@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import aux
+import Storage
+
+class FileStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.files = [aux.FileMetaData(os.path.join(self.dir, 'd', str(i)), 10, None, i*10)
+                      for i in range(4)]
+        self.spans = aux.SpanTable(self.files, 20)
+        self.pool = Storage.FilePool(max_open=2)
+        self.storage = Storage.FileStorage(self.files, self.spans, self.pool)
+        self.addCleanup(self.storage.close)
+
+    def testLazy(self):
+        self.assertEqual(self.storage.read(0, 0, 20), b'')
+        self.assertEqual(os.listdir(self.dir), [])
+        self.storage.write(1, 0, b'x'*20)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'd'))), ['2', '3'])
+        self.assertEqual(self.storage.read(1, 5, 10), b'x'*10)
+
+    def testCap(self):
+        for i in range(2):
+            self.storage.write(i, 0, bytes([i])*20)
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.storage.read(0, 0, 20), b'\0'*20)
+        self.assertEqual(len(self.pool), 2)
+
+    def testInUseNotClosed(self):
+        with self.pool.open(self.files[0].path, create=True) as f:
+            for i in range(1, 4):
+                with self.pool.open(self.files[i].path, create=True): pass
+            f.write(b'y')
+        self.assertEqual(len(self.pool), 2)
+
+    def testCloseSkipsInUse(self):
+        with self.pool.open(self.files[0].path, create=True) as f:
+            self.storage.close()
+            f.write(b'y')
+        self.assertEqual(len(self.pool), 1)
+        self.storage.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def testMmapCap(self):
+        storage = Storage.MmapStorage(self.files, self.spans, self.pool)
+        self.addCleanup(storage.close)
+        self.assertEqual(storage.read(0, 0, 20), b'')
+        for i in range(2):
+            storage.write(i, 0, bytes([i+1])*20)
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(bytes(storage.read(0, 5, 10)), b'\x01'*10)
+        self.assertEqual(bytes(storage.read(1, 0, 20)), b'\x02'*20)
+        self.assertEqual(len(self.pool), 2)
+
+
+class PieceCacheTest(unittest.TestCase):
+    def testCountsPerPiece(self):
+        cache = Storage.PieceCache(30)
+        for _ in range(4): cache.get(0)
+        self.assertFalse(cache.missed(0))
+        self.assertTrue(cache.missed(0))
+        cache.put(0, b'x'*20)
+        cache.put(1, b'y'*10)
+        for index in (0, 0, 1, 1, 0):
+            cache.get(index)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertFalse(cache.missed(0))
+        cache.put(2, b'z'*10)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.size, 30)
+
+if __name__ == '__main__':
+    unittest.main()
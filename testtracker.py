@@ -0,0 +1,123 @@
+import struct
+import unittest
+from unittest import mock
+from twisted.internet import task, defer
+
+import Tracker
+import HttpTracker
+from aux import IpPortPair
+
+ADDR = ('10.0.0.1', 6969)
+
+class FakeTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def write(self, data, address):
+        self.sent.append((data, address))
+
+
+class UDPTrackerClientTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        for name in ('callLater', 'seconds'):
+            p = mock.patch.object(Tracker.reactor, name, getattr(self.clock, name))
+            p.start()
+            self.addCleanup(p.stop)
+        self.client = Tracker.UDPTrackerClient()
+        self.client.transport = FakeTransport()
+
+    def announce(self):
+        return self.client.request(ADDR, 1, event=0, info_hash=b'i'*20, peer_id=b'p'*20,
+                                   downloaded=0, left=0, uploaded=0, key=0, port=1)
+
+    def last(self):
+        data, _ = self.client.transport.sent[-1]
+        return struct.unpack_from('>8si4s', data)
+
+    def reply_connect(self, cid=b'c'*8):
+        _, action, tid = self.last()
+        self.assertEqual(action, 0)
+        self.client.datagramReceived(struct.pack('>i4s8s', 0, tid, cid), ADDR)
+
+    def reply_announce(self, tid):
+        self.client.datagramReceived(struct.pack('>i4siii', 1, tid, 1800, 0, 0), ADDR)
+
+    def testConcurrentAnnounces(self):
+        d1, d2 = self.announce(), self.announce()
+        self.assertEqual(len(self.client.transport.sent), 1) #one connect for both
+        self.reply_connect()
+        tids = [struct.unpack_from('>8si4s', data)[2] for data, _ in self.client.transport.sent[1:]]
+        self.assertEqual(len(set(tids)), 2)
+        results = []
+        d1.addCallback(results.append)
+        d2.addCallback(results.append)
+        self.reply_announce(tids[1])
+        self.reply_announce(tids[0])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.client.pending(), 0)
+
+    def testConnectionIdCached(self):
+        self.announce()
+        self.reply_connect()
+        self.announce()
+        self.assertEqual(self.last()[:2], (b'c'*8, 1))
+        self.clock.advance(Tracker.CONNECTION_ID_LIFETIME)
+        self.announce()
+        self.assertEqual(self.last()[1], 0)
+
+    def testBackoff(self):
+        d = self.announce()
+        failures = []
+        d.addErrback(failures.append)
+        for n in range(Tracker.MAX_RETRANSMITS):
+            self.clock.advance(Tracker.RETRANSMIT_TIMEOUT*2**n - 1)
+            self.assertEqual(len(self.client.transport.sent), n + 1)
+            self.clock.advance(1)
+        self.assertEqual(len(self.client.transport.sent), Tracker.MAX_RETRANSMITS + 1)
+        self.clock.advance(Tracker.RETRANSMIT_TIMEOUT*2**Tracker.MAX_RETRANSMITS)
+        self.assertTrue(failures[0].check(Tracker.TimeOutException))
+
+    def testScrapeBatches(self):
+        hashes = [bytes([i])*20 for i in range(Tracker.MAX_SCRAPE_HASHES + 1)]
+        result = []
+        self.client.scrape(ADDR, hashes).addCallback(result.append)
+        self.reply_connect()
+        for data, _ in self.client.transport.sent[1:]:
+            _, action, tid = struct.unpack_from('>8si4s', data)
+            self.assertEqual(action, 2)
+            n = (len(data) - 16)//20
+            counts = b''.join(struct.pack('>iii', data[16+20*i], 0, 1) for i in range(n))
+            self.client.datagramReceived(struct.pack('>i4s', 2, tid) + counts, ADDR)
+        self.assertEqual(len(self.client.transport.sent), 3)
+        self.assertEqual(result[0], {h: (h[0], 0, 1) for h in hashes})
+
+    def testCancel(self):
+        d = self.announce()
+        d.addErrback(lambda f: f.trap(defer.CancelledError))
+        self.reply_connect()
+        d.cancel()
+        self.assertEqual(self.client.pending(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class HttpTrackerTest(unittest.TestCase):
+    def testParsePeers(self):
+        data = {b'peers': b'\x0a\x00\x00\x01\x1a\xe1' b'\x0a\x00\x00\x02\x1a\xe2' b'\x00',
+                b'peers6': b'\x00'*15 + b'\x01' + b'\x1a\xe1'}
+        self.assertEqual(HttpTracker.parse_peers(data),
+                         {IpPortPair('10.0.0.1', 6881), IpPortPair('10.0.0.2', 6882),
+                          IpPortPair('::1', 6881)})
+        data = {b'peers': [{b'ip': b'10.0.0.1', b'port': 6881, b'peer id': b'x'*20}]}
+        self.assertEqual(HttpTracker.parse_peers(data), {IpPortPair('10.0.0.1', 6881)})
+
+    def testReply(self):
+        tracker = HttpTracker.HttpTracker(None, 'http://t/announce')
+        result = tracker._response_received({b'interval': 900, b'min interval': 60,
+                                             b'tracker id': b'id', b'peers': b''})
+        self.assertEqual((result.interval, result.min_interval), (900, 60))
+        self.assertEqual(tracker._tracker_id, b'id')
+        self.assertRaises(HttpTracker.HTTPTrackerFailure, tracker._response_received,
+                          {b'failure reason': b'go away'})
+
+if __name__ == '__main__':
+    unittest.main()